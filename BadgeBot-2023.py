@@ -9,12 +9,48 @@ based on a design by Nick Sherman
 Run this in Drawbot (drawbot.com)
 """
 import unicodedata
+import hashlib
+import json
 import string
 from random import choice
+import random
+import multiprocessing
+import tempfile
+import shutil
+import itertools
+import time
+import traceback
+from contextlib import contextmanager
 import os
 from drawBot import *
 import csv
+from collections import OrderedDict, namedtuple
 from easing_functions import *
+from fontTools.ttLib import TTFont
+from fontTools.varLib import instancer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+try:
+    # only needed to save WebP images
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+try:
+    # only makes laying out many names at once faster
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    # PDFKit comes with DrawBot on macOS, and can join PDFs without drawing them again
+    from Quartz import PDFDocument
+    from Foundation import NSURL
+except ImportError:
+    PDFDocument = None
 
 
 def round_to_multiple(number, multiple, direction='up'):
@@ -58,7 +94,8 @@ def strokeHex(myHexValue):
     # this function uses hex2rgb to convert the value, and then applies the stroke
     stroke(*hex2rgb(myHexValue))
 
-"""
+# the colors from the conference website
+cssVariables = """
 --accent-color: #000;
 --accent-color-light: #000;
 --bg-color: #5FC6A0;
@@ -103,72 +140,118 @@ def strokeHex(myHexValue):
 --yellow: #FFE12E;
 """
 
-colorPalettes = {
-   'cinammon': {
-        'background': hex2rgb('#EDCCEB'),
-        'text': hex2rgb('#a62116'),
-        #'pattern': hex2rgb('#a62116'),
-        'pattern': hex2rgb('#ffffff'),
-        'name': hex2rgb('#ff0000'),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#890E0E'),
-    },
-    
-   'watermelon': {
-        'background': hex2rgb('#5FC6A0'),
-        'text': (30/255, 48/255, 18/255),
-        'pattern': (255/255, 237/255, 216/255),
-        'name': (255/255, 0, 0),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#3E252A'),
-    },
-    
-   'juicy': {
-        'background': hex2rgb('#8DD951'),
-        'text': (30/255, 48/255, 18/255),
-        'pattern': (255/255, 237/255, 216/255),
-        'name': (253/255, 73/255, 159/255),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#3E252A'),
-    },
- 
-   'taffy': {
-        'background': hex2rgb('#0DBBD6'),
-        'text': (33/255, 31/255, 33/255),
-        'pattern': (255/255, 237/255, 216/255),
-        'name': (253/255, 73/255, 159/255),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#3E252A'),
-    },
-    
-   'bubblegum': {
-        'background': hex2rgb('#FD499F'),
-        'text': (33/255, 31/255, 33/255),
-        'pattern': (255/255, 225/255, 46/255),
-        'name': (242/255, 184/255, 197/255),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#17388C'),
-    },
-    
-   'sherbet': {
-        'background': hex2rgb('#F9A866'),
-        'text': (33/255, 31/255, 33/255),
-        'pattern': (255/255, 237/255, 216/255),
-        'name': (13/255, 187/255, 214/255),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#672728'),
-    },
-    
-   'primary': {
-        'background': hex2rgb('#FFE12E'),
-        'text': (33/255, 31/255, 33/255),
-        'pattern': (13/255, 187/255, 214/255),
-        'name': (1, 0, 0),
-        'shine': hex2rgb('#FFFFFF'),
-        'shade': hex2rgb('#672728'),
-    },
-   
-}
+def parseCSSColors(cssText):
+    """
+    Read the hex colors out of a block of css variables, ‘--red: #B50000;’ => {'--red': (0.71, 0, 0)}.
+    """
+    cssColors = {}
+    for cssLine in cssText.splitlines():
+        if ':' not in cssLine:
+            continue
+        variable, value = cssLine.split(':', 1)
+        value = value.strip().rstrip(';')
+        if not value.startswith('#'):
+            continue
+        value = value.lstrip('#')
+        # expand shorthand like #F00
+        if len(value) in [3, 4]:
+            value = ''.join(character*2 for character in value)
+        cssColors[variable.strip()] = hex2rgb(value)
+    return cssColors
+
+cssColors = parseCSSColors(cssVariables)
+
+# the colors of a badge, by role
+Palette = namedtuple('Palette', ['background', 'text', 'pattern', 'name', 'shine', 'shade'])
+
+# each role is a css variable from the website, or a hex color of its own
+paletteSpecs = OrderedDict([
+    ('cinammon', {
+        'background': '--pink-light',
+        'text': '#a62116',
+        #'pattern': '#a62116',
+        'pattern': '--white',
+        'name': '--red-bright',
+        'shine': '--white',
+        'shade': '--red-dark',
+    }),
+    ('watermelon', {
+        'background': '--green-light',
+        'text': '--green-black',
+        'pattern': '--tan',
+        'name': '--red-bright',
+        'shine': '--white',
+        'shade': '--brown-dark',
+    }),
+    ('juicy', {
+        'background': '--green',
+        'text': '--green-black',
+        'pattern': '--tan',
+        'name': '--pink-hot',
+        'shine': '--white',
+        'shade': '--brown-dark',
+    }),
+    ('taffy', {
+        'background': '--blue',
+        'text': '--black-cool',
+        'pattern': '--tan',
+        'name': '--pink-hot',
+        'shine': '--white',
+        'shade': '--brown-dark',
+    }),
+    ('bubblegum', {
+        'background': '--pink-hot',
+        'text': '--black-cool',
+        'pattern': '--yellow',
+        'name': '--pink',
+        'shine': '--white',
+        'shade': '--blue-dark',
+    }),
+    ('sherbet', {
+        'background': '--orange',
+        'text': '--black-cool',
+        'pattern': '--tan',
+        'name': '--blue',
+        'shine': '--white',
+        'shade': '--brown',
+    }),
+    ('primary', {
+        'background': '--yellow',
+        'text': '--black-cool',
+        'pattern': '--blue',
+        'name': '--red-bright',
+        'shine': '--white',
+        'shade': '--brown',
+    }),
+])
+
+def buildPaletteTable(specs):
+    """
+    Resolve the palette specs into a table of Palettes, indexed by palette id,
+    and a dictionary to look up the id of each palette name.
+    """
+    paletteTable = []
+    paletteIds = {}
+    for paletteName, spec in specs.items():
+        colors = []
+        for role in Palette._fields:
+            color = spec[role]
+            colors.append(cssColors[color] if color.startswith('--') else hex2rgb(color))
+        paletteIds[paletteName] = len(paletteTable)
+        paletteTable.append(Palette(*colors))
+    return tuple(paletteTable), paletteIds
+
+def loadPaletteTheme(themePath):
+    """
+    Read palette specs from a json theme file, in the same form as paletteSpecs.
+    """
+    with open(themePath, 'r', encoding='utf-8') as themeFile:
+        return OrderedDict(json.load(themeFile, object_pairs_hook=OrderedDict))
+
+# point this at a json file to use other palettes. It is read when the script is
+# loaded, so worker processes get the same palettes.
+paletteThemePath = None
+paletteTable, paletteIds = buildPaletteTable(loadPaletteTheme(paletteThemePath) if paletteThemePath else paletteSpecs)
 
 
     
@@ -181,13 +264,154 @@ patternText = [
 """454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545454545""",
     ]
 
+## PROFILING
+
+# turn this on to find out where the time goes in a run.
+# every stage keeps a count, the total time and the slowest time, and each
+# badge’s time is added to its attendee so we can list the slowest names.
+profiling = False
+profileStats = OrderedDict()
+profileAttendees = {}
+profileEvents = []
+profileStart = time.perf_counter()
+
+@contextmanager
+def profileStage(stage, attendee=None):
+    if not profiling:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats = profileStats.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        if attendee is not None:
+            profileAttendees[attendee] = profileAttendees.get(attendee, 0) + elapsed
+        # chrome trace events are in microseconds
+        profileEvents.append({
+            'name': stage,
+            'ph': 'X',
+            'ts': (start - profileStart) * 1000000,
+            'dur': elapsed * 1000000,
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {'attendee': attendee} if attendee is not None else {},
+            })
+
+def startWorkerProfile(profilingEnabled, parentStart):
+    # spawned workers start from a fresh import, so the pool initializer passes the
+    # flag along, and the parent's start time so the trace lines up
+    global profiling, profileStart
+    profiling = profilingEnabled
+    profileStart = parentStart
+
+def takeWorkerProfile():
+    # hand what a worker timed back to the parent, and start over for the next task
+    workerProfile = (dict(profileStats), dict(profileAttendees), list(profileEvents))
+    profileStats.clear()
+    profileAttendees.clear()
+    del profileEvents[:]
+    return workerProfile
+
+def mergeWorkerProfile(workerProfile):
+    workerStats, workerAttendees, workerEvents = workerProfile
+    for stage, workerStageStats in workerStats.items():
+        stats = profileStats.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0})
+        stats['count'] += workerStageStats['count']
+        stats['total'] += workerStageStats['total']
+        stats['max'] = max(stats['max'], workerStageStats['max'])
+    for attendee, seconds in workerAttendees.items():
+        profileAttendees[attendee] = profileAttendees.get(attendee, 0) + seconds
+    profileEvents.extend(workerEvents)
+
+def printProfileReport(slowestCount=10):
+    """
+    Print a table of the time spent in each stage, and the slowest attendees.
+    """
+    print('%-20s %8s %10s %10s %10s' % ('stage', 'count', 'total (s)', 'mean (ms)', 'max (ms)'))
+    for stage, stats in profileStats.items():
+        print('%-20s %8s %10.3f %10.2f %10.2f' % (stage, stats['count'], stats['total'], stats['total'] / stats['count'] * 1000, stats['max'] * 1000))
+    print()
+    print('slowest attendees')
+    slowest = sorted(profileAttendees.items(), key=lambda item: item[1], reverse=True)
+    for attendee, seconds in slowest[:slowestCount]:
+        print('%10.2f ms  %s' % (seconds * 1000, attendee))
+
+def saveProfileTrace(tracePath):
+    """
+    Save the stages in Chrome’s trace format, to open in chrome://tracing or Perfetto.
+    """
+    with open(tracePath, 'w', encoding='utf-8') as traceFile:
+        json.dump({'traceEvents': profileEvents}, traceFile)
+
+
+## PATTERN CACHE
 
-# keep track of folks whose names will not be on three lines
-linebreakExceptions = [] 
+# laying out the pattern is the slowest part of a badge: hundreds of glyphs in a
+# box ten badges wide, almost all of which get clipped away. So we shape each
+# stripe once, trim it to the badge, and keep the outlines around for reuse.
+# The cache forgets the least recently used stripes so memory stays bounded.
+patternCacheSize = 32
+patternCache = OrderedDict()
+
+def getPatternPath(pattern, patternFontSize, boxWidth, boxHeight, bleedLeft=0, bleedRight=0):
+    """
+    Return the pattern text as a single BezierPath, trimmed to the badge and its bleeds.
+    The color is applied when the path is drawn, so every palette shares the same outlines.
+    """
+    key = (pattern, patternFontSize, boxWidth, boxHeight, bleedLeft, bleedRight)
+    if key in patternCache:
+        patternCache.move_to_end(key)
+        return patternCache[key]
+    patternFs = FormattedString(pattern, font=getFontName(patternFont), fontSize=patternFontSize, lineHeight=patternFontSize)
+    bp = BezierPath()
+    bp.textBox(patternFs, (-patternFontSize, -boxHeight, boxWidth*10, boxHeight*2))
+    # throw away everything outside of the badge now, rather than on every badge
+    badgeRect = BezierPath()
+    badgeRect.rect(-bleedLeft, 0, boxWidth+bleedLeft+bleedRight, boxHeight)
+    bp = bp & badgeRect
+    patternCache[key] = bp
+    if len(patternCache) > patternCacheSize:
+        patternCache.popitem(last=False)
+    return bp
+
+
+# keep track of folks whose names are not broken the usual way, and why,
+# so they can all be proofed in one pass instead of paging through the PDF.
+# the reasons are 'one line', 'first name split', 'last name split', 'four lines' and 'hyphen'
+linebreakExceptions = OrderedDict()
+
+def addLinebreakException(theName, reasons):
+    if theName not in linebreakExceptions:
+        linebreakExceptions[theName] = list(reasons)
+
+def saveLinebreakExceptions(reportPath):
+    """
+    Write the linebreak exceptions to a .csv or .json file for proofing.
+    """
+    if reportPath.endswith('.json'):
+        with open(reportPath, 'w', encoding='utf-8') as reportFile:
+            json.dump([
+                {'name': theName, 'lines': theName.split('\n'), 'reasons': reasons}
+                for theName, reasons in linebreakExceptions.items()
+                ], reportFile, ensure_ascii=False, indent=1)
+    else:
+        with open(reportPath, 'w', encoding='utf-8', newline='') as reportFile:
+            reportWriter = csv.writer(reportFile)
+            reportWriter.writerow(['Name', 'Lines', 'Reasons'])
+            for theName, reasons in linebreakExceptions.items():
+                reportWriter.writerow([theName.replace('\n', ' / '), theName.count('\n')+1, ', '.join(reasons)])
 
 # black bar at the bottom with affiliation
 showCompany = True
 
+# the layers of a badge, from the bottom up
+badgeLayers = ['background', 'pattern', 'name', 'company']
+
 ## VARIABLES
 
 pt = 72                # 72pt in an inch
@@ -214,14 +438,235 @@ nameFonts = {
     'shine': nameFontShine
     }
 
+companyVariations = {'wdth': 93}
+companySize = 11
+
+# every font the badges use
+allFonts = [nameFont, nameFontShade, nameFontShine, patternFont, companyFont]
 
+# open all of the fonts when the script starts, instead of when each is first used
+preloadFontsAtStartup = False
 
-def parseRowData(rowData, colHeaders):
-    # a quick way to just get the rows we need from the eventbrite csv
-    firstName = rowData[colHeaders.index('First Name')]
-    lastName = rowData[colHeaders.index('Last Name')]
-    company = rowData[colHeaders.index('Company')]
-    return firstName, lastName, company
+
+## FONTS
+
+# Each font is opened once per process, and only when it is first needed:
+# for drawing, by asking DrawBot for its name, and for measuring, with fontTools.
+fontNames = {}
+fontFiles = {}
+fontMetrics = {}
+
+def getVariationKey(fontPath, variations=None):
+    return (fontPath, tuple(sorted(variations.items())) if variations else None)
+
+def getFontName(fontPath):
+    # the name DrawBot knows the font by, once it has been opened
+    if fontPath not in fontNames:
+        fontNames[fontPath] = font(fontPath) or fontPath
+    return fontNames[fontPath]
+
+def getTTFont(fontPath, variations=None):
+    """
+    The fontTools font, instanced at the variations if there are any.
+    """
+    key = getVariationKey(fontPath, variations)
+    if key not in fontFiles:
+        ttFont = TTFont(fontPath, lazy=not variations)
+        if variations and 'fvar' in ttFont:
+            ttFont = instancer.instantiateVariableFont(ttFont, variations)
+        fontFiles[key] = ttFont
+    return fontFiles[key]
+
+def getFontMetrics(fontPath, variations=None):
+    """
+    The metrics the layout code needs, at a font size of 1pt:
+    capHeight, ascender and descender, the set of supported code points (cmap)
+    and the advance width of every code point (advances).
+    """
+    key = getVariationKey(fontPath, variations)
+    if key not in fontMetrics:
+        ttFont = getTTFont(fontPath, variations)
+        unitsPerEm = ttFont['head'].unitsPerEm
+        os2 = ttFont['OS/2'] if 'OS/2' in ttFont else None
+        cmap = ttFont.getBestCmap()
+        hmtx = ttFont['hmtx']
+        fontMetrics[key] = {
+            'unitsPerEm': unitsPerEm,
+            # older OS/2 tables do not have a cap height
+            'capHeight': getattr(os2, 'sCapHeight', 0) / unitsPerEm,
+            'ascender': ttFont['hhea'].ascent / unitsPerEm,
+            'descender': ttFont['hhea'].descent / unitsPerEm,
+            'cmap': frozenset(cmap),
+            'advances': dict((codepoint, hmtx[glyphName][0] / unitsPerEm) for codepoint, glyphName in cmap.items()),
+            }
+    return fontMetrics[key]
+
+def getKerning(ttFont, cmap):
+    """
+    Flatten the font’s kerning into {(left code point, right code point): value in font units},
+    from the kern feature in GPOS, or an old style kern table.
+    """
+    glyphCodepoints = {}
+    for codepoint, glyphName in cmap.items():
+        glyphCodepoints.setdefault(glyphName, []).append(codepoint)
+    glyphKerning = {}
+
+    if 'GPOS' in ttFont and ttFont['GPOS'].table.LookupList:
+        gpos = ttFont['GPOS'].table
+        lookupIndexes = []
+        for featureRecord in gpos.FeatureList.FeatureRecord:
+            if featureRecord.FeatureTag == 'kern':
+                lookupIndexes.extend(featureRecord.Feature.LookupListIndex)
+        for lookupIndex in sorted(set(lookupIndexes)):
+            lookup = gpos.LookupList.Lookup[lookupIndex]
+            # within a lookup the first subtable that has the pair wins, even with a
+            # value of 0, but the lookups each apply in turn, so those add up
+            lookupKerning = {}
+            for subtable in lookup.SubTable:
+                if lookup.LookupType == 9:
+                    subtable = subtable.ExtSubTable
+                if getattr(subtable, 'LookupType', 2) != 2:
+                    continue
+                if subtable.Format == 1:
+                    for leftGlyph, pairSet in zip(subtable.Coverage.glyphs, subtable.PairSet):
+                        for pairValue in pairSet.PairValueRecord:
+                            value = getattr(pairValue.Value1, 'XAdvance', 0) if pairValue.Value1 else 0
+                            lookupKerning.setdefault((leftGlyph, pairValue.SecondGlyph), value)
+                elif subtable.Format == 2:
+                    leftClasses = subtable.ClassDef1.classDefs
+                    rightClasses = subtable.ClassDef2.classDefs
+                    for leftGlyph in subtable.Coverage.glyphs:
+                        classRecords = subtable.Class1Record[leftClasses.get(leftGlyph, 0)].Class2Record
+                        for rightGlyph in glyphCodepoints:
+                            value1 = classRecords[rightClasses.get(rightGlyph, 0)].Value1
+                            value = getattr(value1, 'XAdvance', 0) if value1 else 0
+                            lookupKerning.setdefault((leftGlyph, rightGlyph), value)
+            for pair, value in lookupKerning.items():
+                if value:
+                    glyphKerning[pair] = glyphKerning.get(pair, 0) + value
+    elif 'kern' in ttFont:
+        for kernTable in ttFont['kern'].kernTables:
+            for pair, value in getattr(kernTable, 'kernTable', {}).items():
+                glyphKerning.setdefault(pair, value)
+
+    kerning = {}
+    for (leftGlyph, rightGlyph), value in glyphKerning.items():
+        for leftCodepoint in glyphCodepoints.get(leftGlyph, []):
+            for rightCodepoint in glyphCodepoints.get(rightGlyph, []):
+                kerning[(leftCodepoint, rightCodepoint)] = value
+    return kerning
+
+def getFontKerning(fontPath, variations=None):
+    """
+    The kerning pairs of a font, at a font size of 1pt.
+    """
+    metrics = getFontMetrics(fontPath, variations)
+    if 'kerning' not in metrics:
+        ttFont = getTTFont(fontPath, variations)
+        unitsPerEm = metrics['unitsPerEm']
+        metrics['kerning'] = dict((pair, value / unitsPerEm) for pair, value in getKerning(ttFont, ttFont.getBestCmap()).items())
+    return metrics['kerning']
+
+def measureText(text, fontPath, fontSize, variations=None):
+    """
+    The width of the widest line of text, added up from the font’s advance widths
+    and kerning, without asking DrawBot to set it.
+    Returns None if the font is missing any of the characters, since DrawBot
+    will set those in the fallback font, which only DrawBot can measure.
+    """
+    advances = getFontMetrics(fontPath, variations)['advances']
+    kerning = getFontKerning(fontPath, variations)
+    longest = 0
+    for line in text.split('\n'):
+        width = 0
+        previous = None
+        for character in line:
+            codepoint = ord(character)
+            if codepoint not in advances:
+                return None
+            width += advances[codepoint]
+            if previous is not None:
+                width += kerning.get((previous, codepoint), 0)
+            previous = codepoint
+        longest = max(longest, width)
+    return longest * fontSize
+
+def preloadFonts():
+    """
+    Open every font for drawing and measuring now, rather than during the first badge.
+    """
+    for fontPath in allFonts:
+        getFontName(fontPath)
+        if os.path.exists(fontPath):
+            getFontMetrics(fontPath)
+    if os.path.exists(companyFont):
+        getFontMetrics(companyFont, companyVariations)
+
+
+
+## ATTENDEES
+
+# just the fields we need from a row of the csv
+Attendee = namedtuple('Attendee', ['firstName', 'lastName', 'company', 'ticketType'])
+
+# which column holds each field, for the exports we have dealt with.
+# a column can be given by its header, or by its position if there is no header,
+# or as a list of those to try in order
+columnMappings = {
+    'eventbrite': {
+        'firstName': 'First Name',
+        'lastName': 'Last Name',
+        'company': 'Company',
+        # older exports leave the header off, but it is always the ninth column
+        'ticketType': ['Ticket Type', 8],
+        },
+    }
+columnMapping = columnMappings['eventbrite']
+
+# we can get by without the other columns, but not without a name
+requiredFields = ['firstName', 'lastName']
+
+def buildHeaderIndex(colHeaders, mapping=None, neededFields=()):
+    """
+    Find the column of every attendee field once, rather than for every row.
+    neededFields are fields that are optional in general, but that the caller
+    filters on, so they must be found too.
+    """
+    if mapping is None:
+        mapping = columnMapping
+    headerIndex = []
+    for field in Attendee._fields:
+        columns = mapping.get(field)
+        if not isinstance(columns, list):
+            columns = [columns]
+        for column in columns:
+            if isinstance(column, int):
+                headerIndex.append(column)
+                break
+            elif column in colHeaders:
+                headerIndex.append(colHeaders.index(column))
+                break
+        else:
+            if field in requiredFields or field in neededFields:
+                raise ValueError('no column for %s (looking for %s)' % (field, ' or '.join(repr(column) for column in columns)))
+            headerIndex.append(None)
+    return headerIndex
+
+def parseRowData(rowData, headerIndex):
+    # a quick way to just get the rows we need from the csv
+    return Attendee(*[
+        rowData[column] if column is not None and column < len(rowData) else ''
+        for column in headerIndex
+        ])
+
+def filterAttendees(attendees, excludeTicketTypes=()):
+    """
+    Skip attendees whose ticket type mentions any of excludeTicketTypes, like 'Livestream'.
+    """
+    for attendee in attendees:
+        if any(ticketType in attendee.ticketType for ticketType in excludeTicketTypes):
+            continue
+        yield attendee
 
 # NOT USING THIS
 # We use this to add space between the lines. This list is made for Stilla.
@@ -231,41 +676,79 @@ ascenders = [u'Ñ', u'Á', u'À', u'Ú', u'Ó', u'É', u'é']
 
 
 
-def drawCompany(company, companySize, companyWidth, companyHeight, textColor, bottomMargin=0, bleedLeft=0, bleedRight=0, patternFontSize=None, colorPalette=None):
-    
-    trackValue = 0.15
-    wordSpaceTracking = .75
-    
+trackValue = 0.15
+wordSpaceTracking = .75
 
-    companyFs = FormattedString('', font=companyFont, fontSize=companySize, fill=colorPalette['text'], lineHeight=companySize, fontVariations={'wdth': 93}, tracking=trackValue, align="center")
-    for companyChar in company:
-        if companyChar == ' ':
-            companyFs.append(companyChar, tracking=wordSpaceTracking)
-            companyFs.tracking(trackValue)
-        else:
-            companyFs.append(companyChar)
-    
-    cw, ch = textSize(companyFs, width=companyWidth)
+def getCompanyRuns(company):
+    # the company split into runs of words and of spaces, each with its tracking
+    return [[''.join(run), wordSpaceTracking if isSpace else trackValue] for isSpace, run in itertools.groupby(company, lambda companyChar: companyChar == ' ')]
 
-    translate(w/2, 0)
-    
+def getCompanyString(companyRuns, companySize, textColor=white):
+    companyFs = FormattedString('', font=getFontName(companyFont), fontSize=companySize, fill=textColor, lineHeight=companySize, fontVariations=companyVariations, tracking=trackValue, align="center")
+    for runText, runTracking in companyRuns:
+        companyFs.append(runText, tracking=runTracking)
+    return companyFs
+
+def measureCompany(company, companyRuns, companySize, companyWidth):
+    # the tracking goes after every character, and more of it after spaces
+    fastWidth = None
+    if useFontMetrics and os.path.exists(companyFont):
+        fastWidth = measureText(company, companyFont, companySize, companyVariations)
+    if fastWidth is not None:
+        spaceCount = company.count(' ')
+        cw = fastWidth + spaceCount*wordSpaceTracking + (len(company)-spaceCount)*trackValue
+        # anything that wraps is left to DrawBot
+        if cw <= companyWidth:
+            return cw, companySize
+    return textSize(getCompanyString(companyRuns, companySize), width=companyWidth)
+
+# lots of people come from the same company, so each one is only laid out once
+companyLayoutCache = {}
+
+def layoutCompany(company, companySize, companyWidth, patternFontSize):
+    """
+    Work out the runs and size of the company name, and the width of the bar behind it.
+    """
+    key = (company, companySize, companyWidth, patternFontSize, getVariationKey(companyFont, companyVariations))
+    if key in companyLayoutCache:
+        return companyLayoutCache[key]
+    companyRuns = getCompanyRuns(company)
+    cw, ch = measureCompany(company, companyRuns, companySize, companyWidth)
     cwm = cw+30
     cwmu = round_to_multiple(cwm, patternFontSize)
-    cwmu = min(w+1, cwmu)
-    
+    cwmu = min(companyWidth+1, cwmu)
+    layout = {
+        'company': company,
+        'size': companySize,
+        'runs': companyRuns,
+        'width': cw,
+        'height': ch,
+        'barWidth': cwmu,
+        }
+    companyLayoutCache[key] = layout
+    return layout
+
+def drawCompany(company, companySize, companyWidth, companyHeight, textColor, bottomMargin=0, bleedLeft=0, bleedRight=0, patternFontSize=None, colorPalette=None, layout=None):
+    if layout is None:
+        layout = layoutCompany(company, companySize, companyWidth, patternFontSize)
+    companyFs = getCompanyString(layout['runs'], companySize, colorPalette.text)
+    ch = layout['height']
+    cwmu = layout['barWidth']
+
+    translate(companyWidth/2, 0)
     
-    fill(*colorPalette['background'])
-    stroke(*colorPalette['pattern'])
+    fill(*colorPalette.background)
+    stroke(*colorPalette.pattern)
     strokeWidth(0.7)
     rect(-cwmu/2, -10, cwmu, companyHeight+10)
     #with savedState():
-    #    stroke(*colorPalette['pattern'])
+    #    stroke(*colorPalette.pattern)
     #    strokeWidth(0.8)
     #    line((0, companyHeight), (width(), companyHeight))
     
     diff = (companyHeight-ch)/2
         
-    fill(*colorPalette['text'])
+    fill(*colorPalette.text)
     textBox(companyFs, (-cwmu/2, -diff, cwmu, companyHeight), )
 
 def capitalize(theText):
@@ -279,141 +762,484 @@ def capitalize(theText):
         theText = theText.upper()
     return theText
 
-def drawName(firstName, lastName, boxWidth, boxHeight, bleedLeft=0, bleedRight=0, colorPalette=None):
-    # this function draws the attendee’s name
-    with savedState():
-        firstName = firstName.strip()
-        lastName = lastName.strip()
-        # ‘NFC’, ‘NFKC’, ‘NFD’, and ‘NFKD’
-        line1 = capitalize(unicodedata.normalize('NFC', firstName))
-        line2 = capitalize(unicodedata.normalize('NFC', lastName))
-        
-        # depending on the name, figure out how many lines it should appear on
-        # the CSV provides firstName and lastName, we will always break between those
-        oneLine = line1 + ' ' + line2
-        twoLines = line1 + '\n' + line2
-        # figure out if either field has multiple words
-        line1words = line1.split(' ')
-        line2words = line2.split(' ')
-        # if a field has multiple words, by default we will break
-        # but if any word is less than 4 chars, keep them
-        doLine1Split = True
-        doLine2Split = True
-        for word in line1words:
-            if len(word) < 3:
-                doLine1Split = False
-        for word in line2words:
-            if len(word) < 3:
-                doLine2Split = False
+## NAME LAYOUT CACHE
+
+# fitting a name means a lot of text measuring, and reprints, duplicate names and
+# the two-up copies all fit the same name into the same box again. So we keep the
+# result of every fit, keyed by the name, the box and the fonts, and save it to disk
+# so that regenerating a corrected sheet can skip the measuring entirely.
+# Bump the version whenever the fitting rules change, to throw away old layouts.
+nameLayoutCacheVersion = 7
+nameLayoutCache = {}
+fileFingerprints = {}
+
+def getFileFingerprint(filePath):
+    # hash the file, so a new build of a font invalidates anything made with it
+    if filePath not in fileFingerprints:
+        if os.path.exists(filePath):
+            with open(filePath, 'rb') as fingerprintFile:
+                fileFingerprints[filePath] = hashlib.md5(fingerprintFile.read()).hexdigest()
+        else:
+            # installed fonts are referenced by name, so the name will have to do
+            fileFingerprints[filePath] = filePath
+    return fileFingerprints[filePath]
+
+def getNameLayoutKey(firstName, lastName, boxWidth, boxHeight):
+    fontHashes = [getFileFingerprint(nameFonts[layer]) for layer in ['shade', 'name', 'shine']]
+    return '|'.join([
+        unicodedata.normalize('NFC', firstName.strip()),
+        unicodedata.normalize('NFC', lastName.strip()),
+        '%sx%s' % (boxWidth, boxHeight),
+        getFileFingerprint(nameOverridesPath),
+        ] + fontHashes)
+
+def loadNameLayoutCache(cachePath):
+    """
+    Load the name layouts from a previous run, if there are any.
+    """
+    if not os.path.exists(cachePath):
+        return
+    with open(cachePath, 'r', encoding='utf-8') as cacheFile:
+        try:
+            cacheData = json.load(cacheFile)
+        except ValueError:
+            print('ignoring unreadable name layout cache', cachePath)
+            return
+    if cacheData.get('version') == nameLayoutCacheVersion:
+        nameLayoutCache.update(cacheData['layouts'])
+
+def saveNameLayoutCache(cachePath):
+    """
+    Write the name layouts to disk for the next run.
+    """
+    cacheDir = os.path.dirname(cachePath)
+    if cacheDir:
+        os.makedirs(cacheDir, exist_ok=True)
+    with open(cachePath, 'w', encoding='utf-8') as cacheFile:
+        json.dump({'version': nameLayoutCacheVersion, 'layouts': nameLayoutCache}, cacheFile, ensure_ascii=False)
+
+# measure names with the font’s own advance widths and kerning, instead of DrawBot
+useFontMetrics = True
+# also measure with DrawBot, and print any names where the two disagree by more
+# than the tolerance (a fraction of the width)
+validateMeasurements = False
+measurementTolerance = 0.01
+
+def measureNameWidth(text, fontPath, fontSize, theLineHeight, alignment='left'):
+    fastWidth = None
+    if useFontMetrics and os.path.exists(fontPath):
+        # None when the font is missing a character, and DrawBot has to measure
+        fastWidth = measureText(text, fontPath, fontSize)
+        if fastWidth is not None and not validateMeasurements:
+            return fastWidth
+    fs = FormattedString(text, font=getFontName(fontPath), fontSize=fontSize, lineHeight=theLineHeight, fallbackFont=getFontName(nameFontFallback), align=alignment)
+    width = textSize(fs)[0]
+    if fastWidth is None:
+        return width
+    if abs(fastWidth - width) > measurementTolerance * width:
+        print('MEASUREMENT MISMATCH', repr(text), os.path.basename(fontPath), fontSize, fastWidth, width)
+    return fastWidth
+
+## NAME OVERRIDES
+
+# Some names need a hand: more room between the lines for the accents, or a nudge
+# to the left for letters that overhang. Those are kept in nameOverrides.json, next
+# to this script, rather than in the code. Names are looked up by any line, or run
+# of lines, of the name as it is broken on the badge (ignoring the hyphens), and
+# nudges by the first letter of each line. When several names match, the one
+# further down the file wins.
+#   lineGap      space between the lines, as a share of the font size
+#   alignment    "left" or "center"
+#   alignOffset  points to move the name to the right
+#   nudge        a share of the font size to move each line to the right
+nameOverridesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nameOverrides.json')
+# the overrides that were used, so we can point out the ones that were not
+usedNameOverrides = set()
+
+def getOverrideKey(theName):
+    return '\n'.join(capitalize(unicodedata.normalize('NFC', line.strip())).rstrip('-') for line in theName.split('\n'))
+
+def loadNameOverrides(overridesPath):
+    """
+    Read the override table, with the names normalized the same way as the badges.
+    Names map to (position in the file, override), and leading letters to overrides.
+    """
+    overrides = {'names': {}, 'leadingGlyphs': {}}
+    if not os.path.exists(overridesPath):
+        return overrides
+    with open(overridesPath, 'r', encoding='utf-8') as overridesFile:
+        overridesData = json.load(overridesFile)
+    for position, (theName, override) in enumerate(overridesData.get('names', {}).items()):
+        overrides['names'][getOverrideKey(theName)] = (position, override)
+    for glyph, override in overridesData.get('leadingGlyphs', {}).items():
+        overrides['leadingGlyphs'][unicodedata.normalize('NFC', glyph)] = override
+    return overrides
+
+nameOverrides = loadNameOverrides(nameOverridesPath)
+
+def getNameOverrides(theName):
+    """
+    The spacing and alignment of a broken name, and the nudge of each of its lines.
+    Returns lineGapScale, alignment, alignOffset, the nudges as shares of the font
+    size, and the [table, key] of every override that was used.
+    """
+    # add space between lines, factoring in overshoot
+    lineGapScale = .06
+    alignment = "left"
+    alignOffset = 0
+    nameNudge = 0
+    lines = theName.split('\n')
+    keyLines = getOverrideKey(theName).split('\n')
+    matches = []
+    for first in range(len(keyLines)):
+        for last in range(first+1, len(keyLines)+1):
+            match = nameOverrides['names'].get('\n'.join(keyLines[first:last]))
+            if match:
+                matches.append(('\n'.join(keyLines[first:last]),) + match)
+    usedOverrides = []
+    for key, position, override in sorted(matches, key=lambda match: match[1]):
+        lineGapScale = override.get('lineGap', lineGapScale)
+        alignment = override.get('alignment', alignment)
+        alignOffset = override.get('alignOffset', alignOffset)
+        nameNudge = override.get('nudge', nameNudge)
+        usedOverrides.append(['names', key])
+
+    nudges = []
+    for line in lines:
+        glyphOverride = nameOverrides['leadingGlyphs'].get(line[:1])
+        if glyphOverride:
+            nudges.append(nameNudge + glyphOverride.get('nudge', 0))
+            if ['leadingGlyphs', line[:1]] not in usedOverrides:
+                usedOverrides.append(['leadingGlyphs', line[:1]])
+        else:
+            nudges.append(nameNudge)
+    return lineGapScale, alignment, alignOffset, nudges, usedOverrides
+
+def markNameOverridesUsed(layout):
+    for table, key in layout['overrides']:
+        usedNameOverrides.add((table, key))
+
+def recordNameLayout(layout):
+    # note the unusual breaks and the overrides as names are laid out, so that
+    # badges which are never drawn again, like reused ones, still make the reports
+    if layout['breakReasons']:
+        addLinebreakException(layout['name'], layout['breakReasons'])
+    markNameOverridesUsed(layout)
+
+def getUnusedNameOverrides():
+    unused = [('names', key) for key in nameOverrides['names'] if ('names', key) not in usedNameOverrides]
+    unused += [('leadingGlyphs', glyph) for glyph in nameOverrides['leadingGlyphs'] if ('leadingGlyphs', glyph) not in usedNameOverrides]
+    return unused
+
+# set font size tolerances
+# need room at the top and bottom for the repeating slices
+maxFontSize = 95
+threeLineMaxSize = 70
+oneLineMaxSize = 160
+manyLineMaxFontSize = 50
+
+def breakName(firstName, lastName):
+    """
+    Work out where the attendee’s name breaks.
+    Returns the broken name, how many lines it has, and the reasons for any unusual breaks.
+    """
+    firstName = firstName.strip()
+    lastName = lastName.strip()
+    # ‘NFC’, ‘NFKC’, ‘NFD’, and ‘NFKD’
+    line1 = capitalize(unicodedata.normalize('NFC', firstName))
+    line2 = capitalize(unicodedata.normalize('NFC', lastName))
     
-        # if the total name plus space is less than 6 chars, draw it on one line
-        if len(oneLine) < 6 or not line1 or not line2:
-            theName = oneLine
-            if theName not in linebreakExceptions: linebreakExceptions.append(theName)
-        # if the two-line setting is particularly balanced, always draw it on two lines
-        #elif abs(len(line1) - len(line2)) < 3:
-        #    theName = twoLines
-        # if the first name has multiple words and should break
-        elif len(line1words) > 1 and doLine1Split:
-            # in a few situations, both names have multiple words and we will break to four lines
-            if len(line2words) > 1 and doLine2Split:
-                theName = '\n'.join(line1words) + '\n' + '\n'.join(line2words)#+ '!'
-                if theName not in linebreakExceptions: linebreakExceptions.append(theName)
-            # otherwise just break the first name
-            else:
-                theName = '\n'.join(line1words) + '\n' + line2 #+ '!'
-                if theName not in linebreakExceptions: linebreakExceptions.append(theName)
-        # just break the last name
-        elif len(line2words) > 1 and doLine2Split:
-            theName = line1 + '\n' + '\n'.join(line2words) #+ '!'
-            if theName not in linebreakExceptions: linebreakExceptions.append(theName)
-        # in all other cases, just use two lines
+    # depending on the name, figure out how many lines it should appear on
+    # the CSV provides firstName and lastName, we will always break between those
+    oneLine = line1 + ' ' + line2
+    twoLines = line1 + '\n' + line2
+    # figure out if either field has multiple words
+    line1words = line1.split(' ')
+    line2words = line2.split(' ')
+    # if a field has multiple words, by default we will break
+    # but if any word is less than 4 chars, keep them
+    doLine1Split = True
+    doLine2Split = True
+    for word in line1words:
+        if len(word) < 3:
+            doLine1Split = False
+    for word in line2words:
+        if len(word) < 3:
+            doLine2Split = False
+
+    # if the total name plus space is less than 6 chars, draw it on one line
+    if len(oneLine) < 6 or not line1 or not line2:
+        theName = oneLine
+        breakReasons = ['one line']
+    # if the two-line setting is particularly balanced, always draw it on two lines
+    #elif abs(len(line1) - len(line2)) < 3:
+    #    theName = twoLines
+    # if the first name has multiple words and should break
+    elif len(line1words) > 1 and doLine1Split:
+        # in a few situations, both names have multiple words and we will break to four lines
+        if len(line2words) > 1 and doLine2Split:
+            theName = '\n'.join(line1words) + '\n' + '\n'.join(line2words)#+ '!'
+            breakReasons = ['four lines']
+        # otherwise just break the first name
         else:
-            theName = line1 + '\n' + line2
-            
-        theName = theName.replace('-', '-\n')
-        
-        # how many lines did we end up with?
-        lineCount = theName.count('\n')+1
-        
-        # set font size tolerances
-        # need room at the top and bottom for the repeating slices
-        maxFontSize = 95
-        threeLineMaxSize = 70
-        oneLineMaxSize = 160
-        manyLineMaxFontSize = 50
-        theName = theName.strip()
-        
-        # set the font
-        font(nameFont)
-        
-        # get the text proportions at 1pt
-        fontSize(1)
-        lineHeight(1)
-        tw, th = textSize(theName)
-        # calculate the font size using the proportions
-        theFontSize = boxWidth/tw * .9
-        
-        # implement the font size tolerances
-        if theFontSize > maxFontSize and '\n' in theName:
-            theFontSize = maxFontSize
-        if theFontSize > oneLineMaxSize and '\n' not in theName:
-            theFontSize = oneLineMaxSize
-        if theFontSize > threeLineMaxSize and lineCount >= 3:
-            theFontSize = threeLineMaxSize 
-        if lineCount >= 4 and theFontSize > manyLineMaxFontSize:
-            theFontSize = manyLineMaxFontSize
-        # add space between lines, factoring in overshoot
-        lineGap = theFontSize*.06
-        alignment="left"
-        alignOffset = 0
-        if 'JÖRGER' in theName or 'STÖSSINGER' in theName:
-            lineGap = theFontSize*.25
-        if  'TINIZARAY' in theName:
-            lineGap = theFontSize*.15
-        if  'TAMARA\nNAOMI' in theName:
-            lineGap = theFontSize*.15
-            alignment = 'center'
-            alignOffset = 110
-
-        theLineHeight = theFontSize*.5 + lineGap
-
-
-        print(theName, theFontSize)
-
+            theName = '\n'.join(line1words) + '\n' + line2 #+ '!'
+            breakReasons = ['first name split']
+    # just break the last name
+    elif len(line2words) > 1 and doLine2Split:
+        theName = line1 + '\n' + '\n'.join(line2words) #+ '!'
+        breakReasons = ['last name split']
+    # in all other cases, just use two lines
+    else:
+        theName = line1 + '\n' + line2
+        breakReasons = []
         
-        fs = FormattedString(theName, fill=1, font=nameFonts['name'], fontSize=theFontSize, lineHeight=theLineHeight, fallbackFont=nameFontFallback)
-        font(nameFonts['name'])
-        contains = fontContainsCharacters(theName)
-        if not contains:
-            print('MISSING CHARACTERS', theName )
+    if '-' in theName:
+        breakReasons.append('hyphen')
+    theName = theName.replace('-', '-\n')
+    
+    # how many lines did we end up with?
+    lineCount = theName.count('\n')+1
+    return theName.strip(), lineCount, breakReasons
+
+def clampNameSize(theFontSize, multiLine, lineCount):
+    # implement the font size tolerances
+    if theFontSize > maxFontSize and multiLine:
+        theFontSize = maxFontSize
+    if theFontSize > oneLineMaxSize and not multiLine:
+        theFontSize = oneLineMaxSize
+    if theFontSize > threeLineMaxSize and lineCount >= 3:
+        theFontSize = threeLineMaxSize 
+    if lineCount >= 4 and theFontSize > manyLineMaxFontSize:
+        theFontSize = manyLineMaxFontSize
+    return theFontSize
+
+def layoutName(firstName, lastName, boxWidth, boxHeight):
+    """
+    Work out how the attendee’s name is broken, sized and positioned in the box.
+    Returns a dictionary that drawName can draw without measuring anything.
+    """
+    key = getNameLayoutKey(firstName, lastName, boxWidth, boxHeight)
+    if key in nameLayoutCache:
+        recordNameLayout(nameLayoutCache[key])
+        return nameLayoutCache[key]
 
-        tw, th = textSize(fs)
+    theName, lineCount, breakReasons = breakName(firstName, lastName)
+    
+    # get the text proportions at 1pt
+    tw = measureNameWidth(theName, nameFont, 1, 1)
+    # calculate the font size using the proportions
+    theFontSize = boxWidth/tw * .9
+    theFontSize = clampNameSize(theFontSize, '\n' in theName, lineCount)
+
+    lineGapScale, alignment, alignOffset, nudges, usedOverrides = getNameOverrides(theName)
+    lineGap = theFontSize*lineGapScale
+    theLineHeight = theFontSize*.5 + lineGap
+
+    tw = measureNameWidth(theName, nameFonts['name'], theFontSize, theLineHeight)
+    capHeight = getFontMetrics(nameFonts['name'])['capHeight'] if os.path.exists(nameFonts['name']) else 0
+    if capHeight:
+        cap = capHeight*theFontSize
+    else:
+        fs = FormattedString(theName, fill=1, font=getFontName(nameFonts['name']), fontSize=theFontSize, lineHeight=theLineHeight, fallbackFont=getFontName(nameFontFallback))
         cap = fs.fontCapHeight()
-        #thAdjust = th + (cap-theLineHeight )
-        
-        thAdjust = cap*lineCount + lineGap*(lineCount-1)
-        #lineOffset = cap*(lineCount-1)+lineGap*(lineCount-1)
-        xoffset = (boxWidth - tw)/2 + 2
-        yoffset = (boxHeight - thAdjust)/2
-
+    #thAdjust = th + (cap-theLineHeight )
+    
+    thAdjust = cap*lineCount + lineGap*(lineCount-1)
+    #lineOffset = cap*(lineCount-1)+lineGap*(lineCount-1)
+    xoffset = (boxWidth - tw)/2 + 2
+    yoffset = (boxHeight - thAdjust)/2
+
+    lines = theName.split('\n')
+
+    # measure every line of every layer now, so drawing does not have to
+    lineWidths = {}
+    for layer in ['shade', 'name', 'shine']:
+        lineWidths[layer] = []
+        for line in lines:
+            lineWidths[layer].append(measureNameWidth(line, nameFonts[layer], theFontSize, theLineHeight, alignment))
+
+    layout = {
+        'name': theName,
+        'lines': lines,
+        'fontSize': theFontSize,
+        'lineHeight': theLineHeight,
+        'lineGap': lineGap,
+        'cap': cap,
+        'xoffset': xoffset,
+        'yoffset': yoffset,
+        'alignment': alignment,
+        'alignOffset': alignOffset,
+        'nudges': [nudge*theFontSize for nudge in nudges],
+        'lineWidths': lineWidths,
+        'breakReasons': breakReasons,
+        'overrides': usedOverrides,
+        }
+    nameLayoutCache[key] = layout
+    recordNameLayout(layout)
+    return layout
+
+def solveNameSizes(unitWidths, multiLines, lineCounts, lineGapScales, boxWidth, boxHeight, capHeight):
+    """
+    The font size, line spacing and offsets of many names at once, from the width
+    of their widest line at 1pt, with numpy if it is installed.
+    Works out the same numbers as layoutName, in the same order, so they match exactly.
+    """
+    if numpy is None:
+        solved = []
+        for unitWidth, multiLine, lineCount, lineGapScale in zip(unitWidths, multiLines, lineCounts, lineGapScales):
+            theFontSize = clampNameSize(boxWidth/unitWidth * .9, multiLine, lineCount)
+            lineGap = theFontSize*lineGapScale
+            cap = capHeight*theFontSize
+            solved.append((theFontSize, theFontSize*.5 + lineGap, lineGap, cap,
+                (boxWidth - unitWidth*theFontSize)/2 + 2,
+                (boxHeight - (cap*lineCount + lineGap*(lineCount-1)))/2))
+        return solved
+
+    unitWidths = numpy.array(unitWidths, dtype=float)
+    multiLines = numpy.array(multiLines, dtype=bool)
+    lineCounts = numpy.array(lineCounts, dtype=float)
+    theFontSizes = boxWidth/unitWidths * .9
+    # the same tolerances as clampNameSize, in the same order
+    theFontSizes = numpy.where((theFontSizes > maxFontSize) & multiLines, maxFontSize, theFontSizes)
+    theFontSizes = numpy.where((theFontSizes > oneLineMaxSize) & ~multiLines, oneLineMaxSize, theFontSizes)
+    theFontSizes = numpy.where((theFontSizes > threeLineMaxSize) & (lineCounts >= 3), threeLineMaxSize, theFontSizes)
+    theFontSizes = numpy.where((lineCounts >= 4) & (theFontSizes > manyLineMaxFontSize), manyLineMaxFontSize, theFontSizes)
+    lineGaps = theFontSizes*numpy.array(lineGapScales, dtype=float)
+    caps = capHeight*theFontSizes
+    solved = zip(
+        theFontSizes,
+        theFontSizes*.5 + lineGaps,
+        lineGaps,
+        caps,
+        (boxWidth - unitWidths*theFontSizes)/2 + 2,
+        (boxHeight - (caps*lineCounts + lineGaps*(lineCounts-1)))/2,
+        )
+    return [tuple(float(value) for value in values) for values in solved]
+
+def canLayoutNamesWithFontTools():
+    # whether names can be laid out from the font files alone, without DrawBot
+    if not useFontMetrics or validateMeasurements:
+        return False
+    if not all(os.path.exists(nameFonts[layer]) for layer in nameFonts):
+        return False
+    return bool(getFontMetrics(nameFont)['capHeight'])
+
+def layoutNames(names, boxWidth, boxHeight):
+    """
+    Lay out a whole list of (firstName, lastName) pairs at once, the same way
+    layoutName does one at a time, and put them in the name layout cache for
+    drawName. Returns the layouts, in the same order as the names.
+    Each line is only measured once, however many names share it.
+    """
+    names = list(names)
+    # without the font files, or when checking measurements, go one at a time
+    if not canLayoutNamesWithFontTools():
+        return [layoutName(firstName, lastName, boxWidth, boxHeight) for firstName, lastName in names]
+    capHeight = getFontMetrics(nameFont)['capHeight']
+
+    # break every name we have not seen before
+    pending = OrderedDict()
+    for firstName, lastName in names:
+        key = getNameLayoutKey(firstName, lastName, boxWidth, boxHeight)
+        if key not in nameLayoutCache and key not in pending:
+            pending[key] = (firstName, lastName)
+    breaks = [breakName(firstName, lastName) for firstName, lastName in pending.values()]
+
+    # measure every distinct line in every layer at 1pt
+    unitLineWidths = dict((layer, {}) for layer in nameFonts)
+    for theName, lineCount, breakReasons in breaks:
+        for line in theName.split('\n'):
+            for layer in nameFonts:
+                if line not in unitLineWidths[layer]:
+                    unitLineWidths[layer][line] = measureText(line, nameFonts[layer], 1)
+
+    # names with characters from the fallback font are measured by DrawBot, one at a time
+    measuredBreaks = []
+    for key, (firstName, lastName), nameBreak in list(zip(pending, pending.values(), breaks)):
+        if any(unitLineWidths[layer][line] is None for line in nameBreak[0].split('\n') for layer in nameFonts):
+            layoutName(firstName, lastName, boxWidth, boxHeight)
+            del pending[key]
+        else:
+            measuredBreaks.append(nameBreak)
+    breaks = measuredBreaks
+
+    unitWidths = []
+    for (firstName, lastName), (theName, lineCount, breakReasons) in zip(pending.values(), breaks):
+        unitWidth = max(unitLineWidths['name'][line] for line in theName.split('\n'))
+        if not unitWidth:
+            # let layoutName fail on this one the way it always has
+            layoutName(firstName, lastName, boxWidth, boxHeight)
+        unitWidths.append(unitWidth)
+
+    spacings = [getNameOverrides(theName) for theName, lineCount, breakReasons in breaks]
+    solved = solveNameSizes(
+        unitWidths,
+        ['\n' in theName for theName, lineCount, breakReasons in breaks],
+        [lineCount for theName, lineCount, breakReasons in breaks],
+        [spacing[0] for spacing in spacings],
+        boxWidth,
+        boxHeight,
+        capHeight,
+        )
+
+    for key, (theName, lineCount, breakReasons), (lineGapScale, alignment, alignOffset, nudges, usedOverrides), (theFontSize, theLineHeight, lineGap, cap, xoffset, yoffset) in zip(pending, breaks, spacings, solved):
         lines = theName.split('\n')
+        nameLayoutCache[key] = {
+            'name': theName,
+            'lines': lines,
+            'fontSize': theFontSize,
+            'lineHeight': theLineHeight,
+            'lineGap': lineGap,
+            'cap': cap,
+            'xoffset': xoffset,
+            'yoffset': yoffset,
+            'alignment': alignment,
+            'alignOffset': alignOffset,
+            'nudges': [nudge*theFontSize for nudge in nudges],
+            'lineWidths': dict((layer, [unitLineWidths[layer][line]*theFontSize for line in lines]) for layer in ['shade', 'name', 'shine']),
+            'breakReasons': breakReasons,
+            'overrides': usedOverrides,
+            }
+    layouts = [nameLayoutCache[getNameLayoutKey(firstName, lastName, boxWidth, boxHeight)] for firstName, lastName in names]
+    for layout in layouts:
+        recordNameLayout(layout)
+    return layouts
+
+def drawName(firstName, lastName, boxWidth, boxHeight, bleedLeft=0, bleedRight=0, colorPalette=None, layout=None):
+    # this function draws the attendee’s name
+    with savedState():
+        if layout is None:
+            with profileStage('name layout'):
+                layout = layoutName(firstName, lastName, boxWidth, boxHeight)
+        else:
+            # laid out ahead of time, maybe in another run, like the plans
+            recordNameLayout(layout)
+        theName = layout['name']
+        theFontSize = layout['fontSize']
+        theLineHeight = layout['lineHeight']
+        lineGap = layout['lineGap']
+        cap = layout['cap']
+        alignment = layout['alignment']
+        alignOffset = layout['alignOffset']
+        lines = layout['lines']
+        lineCount = len(lines)
 
+        print(theName, theFontSize)
 
-        translate(xoffset, yoffset)
-        for hit, layer in enumerate(['shade', 'name', 'shine']):
+        translate(layout['xoffset'], layout['yoffset'])
+        for layer, layerColor in [('shade', colorPalette.shade), ('name', colorPalette.name), ('shine', colorPalette.shine)]:
             with savedState():
                 translate(0, cap*(lineCount-1)+lineGap*(lineCount-1))
                 for lineNumber, line in enumerate(lines):
                     if layer == 'name':
-                        print(colorPalette[layer])
+                        print(layerColor)
                     
-                    fs = FormattedString(fill=colorPalette[layer], font=nameFonts[layer], fontSize=theFontSize, lineHeight=theLineHeight, fallbackFont=nameFontFallback, align=alignment)
+                    fs = FormattedString(fill=layerColor, font=getFontName(nameFonts[layer]), fontSize=theFontSize, lineHeight=theLineHeight, fallbackFont=getFontName(nameFontFallback), align=alignment)
                     if layer == 'shine':
                         fs.append('')
                     fs.append(line)
                     with savedState():
-                       if textSize(fs)[0] < w/2.25 and theFontSize < 55:
+                       if layout['lineWidths'][layer][lineNumber] < boxWidth/2.25 and theFontSize < 55:
                            if lineNumber != 0:
                                pass
                            scale(1)
@@ -421,11 +1247,7 @@ def drawName(firstName, lastName, boxWidth, boxHeight, bleedLeft=0, bleedRight=0
                        else:
                            extraSpaceBelow = False
                    
-                       nudge = 0 + alignOffset
-                       if fs[0] == 'J':
-                           nudge += -.05*theFontSize
-                       elif fs[0] == 'T':
-                           nudge += -.025*theFontSize
+                       nudge = alignOffset + layout['nudges'][lineNumber]
                            
                        text(fs, (nudge, 0))
                        stroke(None)
@@ -434,40 +1256,55 @@ def drawName(firstName, lastName, boxWidth, boxHeight, bleedLeft=0, bleedRight=0
                         translate(0, -lineGap)
                 
     
-def drawBadge(w, h, firstName, lastName, company=None, setSize=True, DEBUG=False, phase=0, bleedLeft=0, bleedRight=0, bgIndex=None, colorPalette=None, pattern=None):
+def getPatternOffset(phase, patternFontSize):
+    # the pattern eases one slice to the right and back again over the animation,
+    # so it is still at rest at both phase 0 and phase 1
+    return SineEaseInOut(start=0, end=patternFontSize, duration=1).ease(1 - abs(2*phase - 1))
+
+def drawBadge(w, h, firstName, lastName, company=None, setSize=True, DEBUG=False, phase=0, bleedLeft=0, bleedRight=0, bgIndex=None, colorPalette=None, pattern=None, layers=None, nameLayout=None, companyLayout=None):
     """
     Draw one badge. This handles the positioning, and lets other functions do the drawing.
+    Layers can limit the drawing to some of 'background', 'pattern', 'name' and 'company'.
+    The name and company layouts can be given, from a plan, instead of worked out here.
     """
+    if layers is None:
+        layers = badgeLayers
     
 
     if setSize:
         newPage(w, h)
     boxWidth = w
     boxHeight = h
-    with savedState():
+    with profileStage('badge', '%s %s' % (firstName, lastName)), savedState():
         bp = BezierPath()
         bp.rect(-bleedLeft, 0, w+bleedLeft+bleedRight, h)
         clipPath(bp)
 
         # draw the background
-        backgroundColor=colorPalette['background']
-        if backgroundColor:
+        backgroundColor=colorPalette.background
+        if backgroundColor and 'background' in layers:
             fill(*backgroundColor)
             rect(-bleedLeft, 0, w+bleedLeft+bleedRight, h)
 
         patternFontSize = h/6
-        font(patternFont, patternFontSize)
-        lineHeight(patternFontSize)
-        fill(*colorPalette['pattern'])
+        fill(*colorPalette.pattern)
         if pattern is None:
             pattern = choice(patternText)*6
-        
-        textBox(pattern, (-patternFontSize, -boxHeight, boxWidth*10, boxHeight*2))
+        # the pattern is shaped once and reused, see getPatternPath
+        if 'pattern' in layers:
+            with profileStage('pattern'):
+                patternOffset = getPatternOffset(phase, patternFontSize)
+                if patternOffset:
+                    # shape an extra slice on the left to slide in from under the clip
+                    translate(patternOffset, 0)
+                    drawPath(getPatternPath(pattern, patternFontSize, boxWidth, boxHeight, bleedLeft+patternFontSize, bleedRight))
+                    translate(-patternOffset, 0)
+                else:
+                    drawPath(getPatternPath(pattern, patternFontSize, boxWidth, boxHeight, bleedLeft, bleedRight))
 
 
 
         # print the company name
-        companySize = 11
         affiliateBlock = patternFontSize
         affiliateBottomMargin = 14
 
@@ -482,40 +1319,469 @@ def drawBadge(w, h, firstName, lastName, company=None, setSize=True, DEBUG=False
             boxHeight = boxHeight - affiliateBlock
         else:
             affiliateBlock = 0
-        with savedState():
-            translate(0, affiliateBlock)
-            fill(None)
-            #stroke(1, 0, 0)
-            #strokeWidth(10)
-            #rect(0, 0, boxWidth, boxHeight)
-            sw = drawName(firstName, lastName, boxWidth, boxHeight, colorPalette=colorPalette)
+        if 'name' in layers:
+            with savedState():
+                translate(0, affiliateBlock)
+                fill(None)
+                #stroke(1, 0, 0)
+                #strokeWidth(10)
+                #rect(0, 0, boxWidth, boxHeight)
+                with profileStage('name'):
+                    sw = drawName(firstName, lastName, boxWidth, boxHeight, colorPalette=colorPalette, layout=nameLayout)
         
         # undo company move
-        if company and showCompany:
-            drawCompany(company, companySize, w, affiliateBlock, white, affiliateBottomMargin, bleedLeft, bleedRight, patternFontSize, colorPalette)
+        if company and showCompany and 'company' in layers:
+            with profileStage('company'):
+                drawCompany(company, companySize, w, affiliateBlock, white, affiliateBottomMargin, bleedLeft, bleedRight, patternFontSize, colorPalette, layout=companyLayout)
             
         #oval(210, 10, 1*pt, 1*pt)
             
 
 
+## ANIMATION
+
+# Only the pattern moves from frame to frame. So the name and the company, which
+# take nearly all of the drawing time, are drawn once into a file of their own and
+# placed on top of every frame, and only the background and pattern are redrawn.
+
+def drawBadgeAnimation(w, h, firstName, lastName, company, outputPath, colorPalette=None, pattern=None, totalFrames=30):
+    """
+    Save an animated badge to outputPath.
+    """
+    if pattern is None:
+        pattern = choice(patternText)*6
+    layerDir = tempfile.mkdtemp(prefix='badgebot-layers-')
+    foregroundPath = os.path.join(layerDir, 'foreground.pdf')
+    try:
+        # draw the static layers once
+        newDrawing()
+        try:
+            newPage(w, h)
+            drawBadge(w, h, firstName, lastName, company, setSize=False, colorPalette=colorPalette, pattern=pattern, layers=['name', 'company'])
+            saveImage(foregroundPath)
+        finally:
+            endDrawing()
+
+        newDrawing()
+        try:
+            for f in range(totalFrames):
+                newPage(w, h)
+                frameDuration(1/totalFrames)
+                drawBadge(w, h, firstName, lastName, company, setSize=False, colorPalette=colorPalette, pattern=pattern, phase=f/totalFrames, layers=['background', 'pattern'])
+                image(foregroundPath, (0, 0))
+            saveImage(outputPath)
+        finally:
+            endDrawing()
+    finally:
+        shutil.rmtree(layerDir, ignore_errors=True)
+
+
+## RASTER EXPORT
+
+# Check-in kiosks and lobby screens want a bitmap for every attendee. Each badge
+# is drawn here as a vector file, and a pool of workers turns it into pixels
+# while the next badge is being drawn.
+
+def getAttendeeSlug(attendee):
+    # a file-name friendly version of the name, ‘Zoë Çelik’ => ‘zoe-celik’
+    fullName = unicodedata.normalize('NFKD', '%s %s' % (attendee.firstName, attendee.lastName))
+    fullName = fullName.encode('ascii', 'ignore').decode('ascii').lower()
+    slug = '-'.join(''.join(character if character.isalnum() else ' ' for character in fullName).split())
+    return slug or 'attendee'
+
+def rasterizeBadgeFile(badgePath, imagePath, pixelWidth, pixelHeight, imageFormat):
+    # runs in a worker process: place the vector badge at the pixel size and encode it
+    with profileStage('rasterize'):
+        badgeWidth, badgeHeight = imageSize(badgePath)
+        newDrawing()
+        newPage(pixelWidth, pixelHeight)
+        scale(pixelWidth / badgeWidth, pixelHeight / badgeHeight)
+        image(badgePath, (0, 0))
+        if imageFormat == 'webp':
+            # drawbot cannot write webp, so we go through png
+            pngPath = os.path.splitext(imagePath)[0] + '.png'
+            saveImage(pngPath)
+            PILImage.open(pngPath).save(imagePath, 'WEBP', lossless=True)
+            os.remove(pngPath)
+        else:
+            saveImage(imagePath)
+        endDrawing()
+    os.remove(badgePath)
+    return imagePath, takeWorkerProfile()
+
+def exportRasters(attendees, w, h, outputDir, imageFormat='png', dpi=72, pixelSize=None, processes=None, seed=None):
+    """
+    Save every badge as a png or webp at dpi (or at an exact pixelSize), one file
+    per attendee in folders by first letter, along with an index.json to find them.
+    """
+    if imageFormat not in ['png', 'webp']:
+        raise ValueError('cannot export %s, only png or webp' % imageFormat)
+    if imageFormat == 'webp' and PILImage is None:
+        raise ValueError('saving webp needs Pillow')
+    if pixelSize:
+        pixelWidth, pixelHeight = pixelSize
+    else:
+        pixelWidth, pixelHeight = round(w * dpi / pt), round(h * dpi / pt)
+    badgeDir = tempfile.mkdtemp(prefix='badgebot-raster-')
+    index = {}
+    pending = deque()
+    workers = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=startWorkerProfile, initargs=(profiling, profileStart)) as pool:
+        for i, (attendee, paletteId, patternId) in enumerate(assignDesigns(attendees, seed=seed)):
+            slug = getAttendeeSlug(attendee)
+            relativePath = os.path.join(slug[0], '%s-%05d.%s' % (slug, i, imageFormat))
+            imagePath = os.path.join(outputDir, relativePath)
+            os.makedirs(os.path.dirname(imagePath), exist_ok=True)
+
+            badgePath = os.path.join(badgeDir, '%05d.pdf' % i)
+            newDrawing()
+            newPage(w, h)
+            drawBadge(
+                w,
+                h,
+                attendee.firstName,
+                attendee.lastName,
+                attendee.company,
+                setSize=False,
+                colorPalette=paletteTable[paletteId],
+                pattern=patternText[patternId]*6,
+                )
+            saveImage(badgePath)
+            endDrawing()
+
+            pending.append(pool.submit(rasterizeBadgeFile, badgePath, imagePath, pixelWidth, pixelHeight, imageFormat))
+            # do not get too far ahead of the workers, or the temporary files pile up
+            while len(pending) > workers * 2:
+                mergeWorkerProfile(pending.popleft().result()[1])
+
+            index.setdefault(slug, []).append({
+                'firstName': attendee.firstName,
+                'lastName': attendee.lastName,
+                'company': attendee.company,
+                'path': relativePath,
+                })
+        for future in pending:
+            mergeWorkerProfile(future.result()[1])
+
+    shutil.rmtree(badgeDir)
+    with open(os.path.join(outputDir, 'index.json'), 'w', encoding='utf-8') as indexFile:
+        json.dump({'width': pixelWidth, 'height': pixelHeight, 'format': imageFormat, 'attendees': index}, indexFile, ensure_ascii=False, indent=1)
+
+
+## BADGE SERVICE
+
+# Walk-up registrations need a badge in seconds, not a rerun of the whole script.
+# The service stays running with the fonts loaded and the patterns shaped, and
+# draws one badge per request:
+#
+#     curl -d 'firstName=Nick&lastName=Sherman&company=Typographics' localhost:8023/badge > badge.pdf
+#
+# Add layout=two-up for a pair to fold, like on the sheets. GET /status reports the latency.
+# DrawBot is not thread safe, so requests are handled one at a time.
+
+serviceLatencies = deque(maxlen=1000)
+
+def warmBadgeService(w, h):
+    # open every font and shape every pattern before the first request comes in
+    newDrawing()
+    newPage(w, h)
+    preloadFonts()
+    for pattern in patternText:
+        for bleedLeft, bleedRight in [(0, 0), (100, 0), (0, 100)]:
+            getPatternPath(pattern*6, h/6, w, h, bleedLeft, bleedRight)
+    endDrawing()
+
+def renderServiceBadge(w, h, firstName, lastName, company, layout='single'):
+    """
+    Draw one badge, or two side by side for layout='two-up', and return the PDF data.
+    """
+    pdfFile, pdfPath = tempfile.mkstemp(suffix='.pdf')
+    os.close(pdfFile)
+    newDrawing()
+    try:
+        if layout == 'two-up':
+            sheet = getSheetLayout(w, h, sheetWidth=w*2, sheetHeight=h, margin=0, multiple=2)
+            for pageSlots in paginateSheets([Attendee(firstName, lastName, company, '')], sheet):
+                drawSheetPage(pageSlots, sheet)
+        else:
+            newPage(w, h)
+            drawBadge(
+                w,
+                h,
+                firstName,
+                lastName,
+                company,
+                setSize=False,
+                colorPalette=choice(paletteTable),
+                )
+        saveImage(pdfPath)
+        with open(pdfPath, 'rb') as pdfFile:
+            return pdfFile.read()
+    finally:
+        # a badge that fails to draw must not leave its drawing open for the next request
+        endDrawing()
+        os.remove(pdfPath)
+
+def getLatencyPercentiles(latencies, percentiles=(50, 90, 99)):
+    ordered = sorted(latencies)
+    result = {}
+    for percentile in percentiles:
+        if ordered:
+            result['p%s' % percentile] = ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+        else:
+            result['p%s' % percentile] = None
+    return result
+
+class BadgeRequestHandler(BaseHTTPRequestHandler):
+
+    badgeWidth = 4 * pt
+    badgeHeight = 3 * pt
+    # a name and a company fit in far less than this
+    maxBodySize = 16 * 1024
+    layouts = ['single', 'two-up']
+
+    def sendData(self, data, contentType, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendJSON(self, result, status=200):
+        self.sendData(json.dumps(result).encode('utf-8'), 'application/json', status)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            status = {'badges': len(serviceLatencies), 'latency': getLatencyPercentiles(serviceLatencies)}
+            self.sendJSON(status)
+        elif url.path == '/badge':
+            self.sendBadge(parse_qs(url.query))
+        else:
+            self.sendJSON({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/badge':
+            self.sendJSON({'error': 'not found'}, 404)
+            return
+        try:
+            bodySize = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.sendJSON({'error': 'Content-Length is not a number'}, 400)
+            return
+        if bodySize < 0 or bodySize > self.maxBodySize:
+            self.sendJSON({'error': 'the request can be at most %s bytes' % self.maxBodySize}, 413)
+            return
+        try:
+            body = self.rfile.read(bodySize).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                fields = json.loads(body)
+                if not isinstance(fields, dict):
+                    raise ValueError('the body should be a JSON object')
+                if not all(isinstance(value, str) for value in fields.values()):
+                    raise ValueError('every field should be a string')
+                fields = dict((key, [value]) for key, value in fields.items())
+            else:
+                fields = parse_qs(body)
+        except ValueError as error:
+            # this covers bad utf-8 and bad JSON too
+            self.sendJSON({'error': str(error)}, 400)
+            return
+        self.sendBadge(fields)
+
+    def sendBadge(self, fields):
+        def getField(key):
+            return fields.get(key, [''])[0]
+        if not getField('firstName') and not getField('lastName'):
+            self.sendJSON({'error': 'firstName or lastName is required'}, 400)
+            return
+        layout = getField('layout') or 'single'
+        if layout not in self.layouts:
+            self.sendJSON({'error': 'layout should be one of %s' % ', '.join(self.layouts)}, 400)
+            return
+        start = time.perf_counter()
+        try:
+            pdfData = renderServiceBadge(self.badgeWidth, self.badgeHeight, getField('firstName'), getField('lastName'), getField('company'), layout)
+        except Exception as error:
+            # keep serving the next walk-up, and leave the details in the log
+            self.log_error('could not draw a badge for %r: %r', fields, error)
+            self.sendJSON({'error': 'could not draw the badge'}, 500)
+            return
+        serviceLatencies.append(time.perf_counter() - start)
+        self.sendData(pdfData, 'application/pdf')
+
+def serveBadges(host='127.0.0.1', port=8023):
+    """
+    Draw badges on request until interrupted.
+    """
+    warmBadgeService(BadgeRequestHandler.badgeWidth, BadgeRequestHandler.badgeHeight)
+    server = HTTPServer((host, port), BadgeRequestHandler)
+    print('serving badges at http://%s:%s/badge' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+## GLYPH PREFLIGHT
+
+# Rather than finding out about a missing glyph halfway through a long render,
+# check every attendee against every font before drawing anything.
+# Turn this on to stop the run when something is missing.
+failOnMissingGlyphs = False
+
+def getFontCmap(fontPath):
+    # the set of code points the font supports, read once per font
+    return getFontMetrics(fontPath)['cmap']
+
+def preflightGlyphs(attendees, reportPath=None, failOnMissing=False):
+    """
+    Check the characters of every name, company and pattern against the fonts
+    that will draw them. Returns a list of (font, character, attendees) for
+    every missing glyph, and saves them to reportPath as a csv if given.
+    """
+    # gather every character in use, and who uses it
+    nameCharacters = {}
+    companyCharacters = {}
+    for attendee in attendees:
+        attendeeName = '%s %s' % (attendee.firstName, attendee.lastName)
+        # the same text drawName will set
+        nameText = capitalize(unicodedata.normalize('NFC', attendee.firstName.strip())) + capitalize(unicodedata.normalize('NFC', attendee.lastName.strip()))
+        for character in set(nameText):
+            nameCharacters.setdefault(character, []).append(attendeeName)
+        if attendee.company and attendee.company.upper() != 'N/A' and showCompany:
+            for character in set(attendee.company):
+                companyCharacters.setdefault(character, []).append(attendeeName)
+    patternCharacters = dict((character, ['pattern']) for character in set(''.join(patternText)))
+
+    # then compare each font against everything it needs to draw, all at once
+    checks = [(nameFonts[layer], nameCharacters) for layer in ['shade', 'name', 'shine']]
+    checks.append((companyFont, companyCharacters))
+    checks.append((patternFont, patternCharacters))
+    missingGlyphs = []
+    for fontPath, usedCharacters in checks:
+        if not os.path.exists(fontPath):
+            print('cannot preflight', fontPath)
+            continue
+        # spaces and control characters (the patterns use U+0003 to break lines) are not drawn
+        usedCodepoints = set(ord(character) for character in usedCharacters if not character.isspace() and unicodedata.category(character) != 'Cc')
+        for codepoint in sorted(usedCodepoints - getFontCmap(fontPath)):
+            missingGlyphs.append((fontPath, chr(codepoint), usedCharacters[chr(codepoint)]))
+
+    for fontPath, character, attendeeNames in missingGlyphs:
+        print('MISSING CHARACTERS', os.path.basename(fontPath), character, 'U+%04X' % ord(character), ', '.join(attendeeNames))
+    if reportPath:
+        reportDir = os.path.dirname(reportPath)
+        if reportDir:
+            os.makedirs(reportDir, exist_ok=True)
+        with open(reportPath, 'w', encoding='utf-8', newline='') as reportFile:
+            reportWriter = csv.writer(reportFile)
+            reportWriter.writerow(['Font', 'Character', 'Code Point', 'Attendees'])
+            for fontPath, character, attendeeNames in missingGlyphs:
+                reportWriter.writerow([os.path.basename(fontPath), character, 'U+%04X' % ord(character), '; '.join(attendeeNames)])
+    if missingGlyphs and failOnMissing:
+        raise ValueError('%s missing glyphs, see %s' % (len(missingGlyphs), reportPath))
+    return missingGlyphs
+
+
 ## SHEET FUNCTIONS
 
-def drawCropMarks(rows, cols, boxWidth, boxHeight, badgeWidth, badgeHeight, margin):
-    # assuming we are in the top right, draw crop marks
+# Badges are printed several to a sheet and cut apart. Since we are not printing
+# double-sided, every attendee gets a few copies side by side that are folded
+# along the middle, so the copies are imposed as one unit and never split up.
+# The units can be turned sideways to fill the sheet better, and every layout
+# that fits is tried, keeping the one with the most badges on the sheet.
+
+def drawCropMarks(sheet):
+    # marks in the margin, lined up with the cuts of the badges along that edge.
+    # a strip turned the other way has cuts of its own, so each side only gets
+    # the cuts of the block next to it, and no mark suggests a cut across the
+    # whole sheet that would go through a badge
+    margin = sheet['margin']
+    usedLeft, usedBottom, usedRight, usedTop = [round(value, 3) for value in sheet['usedBounds']]
+    edges = [(round(p['x'], 3), round(p['y'], 3), round(p['x'] + p['width'], 3), round(p['y'] + p['height'], 3)) for p in sheet['placements']]
+    leftCuts = sorted(set(y for left, bottom, right, top in edges if left == usedLeft for y in [bottom, top]))
+    rightCuts = sorted(set(y for left, bottom, right, top in edges if right == usedRight for y in [bottom, top]))
+    topCuts = sorted(set(x for left, bottom, right, top in edges if top == usedTop for x in [left, right]))
+    bottomCuts = sorted(set(x for left, bottom, right, top in edges if bottom == usedBottom for x in [left, right]))
     with savedState():
         stroke(1)
-        for row in range(rows+1):
-            line((-margin, -row*badgeHeight), (-margin/2, -row*badgeHeight))
-            line((boxWidth+margin, -row*badgeHeight), (boxWidth+margin/2, -row*badgeHeight))
-        for col in range(cols+1):
-            line((col*badgeWidth, margin), (col*badgeWidth, margin/2))
-            line((col*badgeWidth, -boxHeight-margin/2), (col*badgeWidth, -boxHeight-margin))
-
-def drawSheets(data, w, h, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, pattern=None):
+        for y in leftCuts:
+            line((usedLeft-margin, y), (usedLeft-margin/2, y))
+        for y in rightCuts:
+            line((usedRight+margin, y), (usedRight+margin/2, y))
+        for x in topCuts:
+            line((x, usedTop+margin), (x, usedTop+margin/2))
+        for x in bottomCuts:
+            line((x, usedBottom-margin/2), (x, usedBottom-margin))
+
+def fitCount(length, size, gutter):
+    # how many of something fit in a length, with a gutter between each
+    if size > length:
+        return 0
+    return int((length + gutter) / (size + gutter) + 1e-9)
+
+def getUnitBlock(left, top, cols, rows, unitWidth, unitHeight, gutter, rotated):
+    # a grid of units, hanging down from the top left corner
+    return [(left + col * (unitWidth + gutter), top - (row + 1) * unitHeight - row * gutter, unitWidth, unitHeight, rotated)
+        for row in range(rows) for col in range(cols)]
+
+def getImpositionCandidates(boxWidth, boxHeight, unitWidth, unitHeight, gutter, margin, sheetHeight, allowRotation=True):
     """
-    Make a sheet of badges for printing purposes.
+    Every way of filling the box with units: all upright, all rotated, and a block
+    of one with a strip of the other along the right or bottom edge.
     """
+    top = sheetHeight - margin
+    orientations = [False, True] if allowRotation else [False]
+    for mainRotated in orientations:
+        mainWidth, mainHeight = (unitHeight, unitWidth) if mainRotated else (unitWidth, unitHeight)
+        stripWidth, stripHeight = (unitWidth, unitHeight) if mainRotated else (unitHeight, unitWidth)
+        maxCols = fitCount(boxWidth, mainWidth, gutter)
+        maxRows = fitCount(boxHeight, mainHeight, gutter)
+        for cols in range(maxCols, -1, -1):
+            units = getUnitBlock(margin, top, cols, maxRows, mainWidth, mainHeight, gutter, mainRotated)
+            if allowRotation:
+                # a strip of the other orientation in what is left on the right
+                usedWidth = cols * (mainWidth + gutter)
+                stripCols = fitCount(boxWidth - usedWidth, stripWidth, gutter)
+                stripRows = fitCount(boxHeight, stripHeight, gutter)
+                units += getUnitBlock(margin + usedWidth, top, stripCols, stripRows, stripWidth, stripHeight, gutter, not mainRotated)
+            yield units
+        if allowRotation:
+            for rows in range(maxRows, -1, -1):
+                # a strip of the other orientation in what is left at the bottom
+                usedHeight = rows * (mainHeight + gutter)
+                stripCols = fitCount(boxWidth, stripWidth, gutter)
+                stripRows = fitCount(boxHeight - usedHeight, stripHeight, gutter)
+                units = getUnitBlock(margin, top, maxCols, rows, mainWidth, mainHeight, gutter, mainRotated)
+                units += getUnitBlock(margin, top - usedHeight, stripCols, stripRows, stripWidth, stripHeight, gutter, not mainRotated)
+                yield units
+
+def getFacingGap(rect, rects, side):
+    # the distance to the nearest rect on one side ('left', 'right', 'bottom' or 'top'), or None
+    x, y, width, height = rect
+    gaps = []
+    for otherX, otherY, otherWidth, otherHeight in rects:
+        if side in ('left', 'right'):
+            if otherY >= y + height or otherY + otherHeight <= y:
+                continue
+            gap = otherX - (x + width) if side == 'right' else x - (otherX + otherWidth)
+        else:
+            if otherX >= x + width or otherX + otherWidth <= x:
+                continue
+            gap = otherY - (y + height) if side == 'top' else y - (otherY + otherHeight)
+        if gap > -1e-6:
+            gaps.append(max(gap, 0))
+    return min(gaps) if gaps else None
 
+def getSheetLayout(w, h, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, gutter=0, bleed=100, allowRotation=True):
+    """
+    Work out how many badges fit on a sheet, and where they go.
+    The multiple copies of a badge are kept together side by side, with a gutter
+    between each group, and the bleed runs off the outside of each group, as far
+    as the gutter lets it.
+    """
     if not badgeWidth:
         badgeWidth = w
     if not badgeHeight:
@@ -524,101 +1790,728 @@ def drawSheets(data, w, h, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None
     # determine available space
     boxWidth = sheetWidth - margin * 2
     boxHeight = sheetHeight - margin * 2
-    # determine number of columns and rows
-    cols = int ( boxWidth / badgeWidth )
-    rows = int ( boxHeight / badgeHeight )
-
-    # reset the box space based on the badge size, rather than the page size
-    boxWidth = cols * badgeWidth
-    boxHeight = rows * badgeHeight
-
-
-    textColor = black
-    nameBoxColor = white
-
+    unitWidth = badgeWidth * multiple
+    unitHeight = badgeHeight
+
+    # keep the layout with the most units, and of those the one turning the fewest
+    bestUnits = []
+    for units in getImpositionCandidates(boxWidth, boxHeight, unitWidth, unitHeight, gutter, margin, sheetHeight, allowRotation):
+        if (len(units), -sum(unit[4] for unit in units)) > (len(bestUnits), -sum(unit[4] for unit in bestUnits)):
+            bestUnits = units
+    if not bestUnits:
+        raise ValueError('A %s by %s badge does not fit on a %s by %s sheet' % (unitWidth, unitHeight, sheetWidth, sheetHeight))
+
+    unitRects = [unit[:4] for unit in bestUnits]
+    placements = []
+    for unitIndex, (x, y, width, height, rotated) in enumerate(bestUnits):
+        otherRects = unitRects[:unitIndex] + unitRects[unitIndex+1:]
+        # the left and right of the badge are the bottom and top of the sheet when rotated
+        bleeds = []
+        for side in (['bottom', 'top'] if rotated else ['left', 'right']):
+            gap = getFacingGap(unitRects[unitIndex], otherRects, side)
+            bleeds.append(bleed if gap is None else min(bleed, gap/2))
+        for copy in range(multiple):
+            placements.append({
+                'unit': unitIndex,
+                'copy': copy,
+                'x': x if rotated else x + copy * badgeWidth,
+                'y': y + copy * badgeWidth if rotated else y,
+                'width': badgeHeight if rotated else badgeWidth,
+                'height': badgeWidth if rotated else badgeHeight,
+                'rotated': rotated,
+                'bleedLeft': bleeds[0] if copy == 0 else 0,
+                'bleedRight': bleeds[1] if copy == multiple - 1 else 0,
+                })
+
+    # the badges each one touches, for spreading out the palettes and patterns
+    neighbors = []
+    for index, placement in enumerate(placements):
+        rect = (placement['x'], placement['y'], placement['width'], placement['height'])
+        touching = []
+        for otherIndex, other in enumerate(placements[:index]):
+            otherRect = (other['x'], other['y'], other['width'], other['height'])
+            for side in ['left', 'right', 'bottom', 'top']:
+                gap = getFacingGap(rect, [otherRect], side)
+                if gap is not None and gap <= gutter + 1e-6:
+                    touching.append(otherIndex)
+                    break
+        neighbors.append(touching)
+
+    usedBounds = (
+        min(p['x'] for p in placements),
+        min(p['y'] for p in placements),
+        max(p['x'] + p['width'] for p in placements),
+        max(p['y'] + p['height'] for p in placements),
+        )
+    rotatedCount = sum(p['rotated'] for p in placements)
+    if not rotatedCount:
+        layoutKind = 'upright'
+    elif rotatedCount == len(placements):
+        layoutKind = 'rotated'
+    else:
+        layoutKind = 'mixed'
+
+    return {
+        'w': w,
+        'h': h,
+        'sheetWidth': sheetWidth,
+        'sheetHeight': sheetHeight,
+        'badgeWidth': badgeWidth,
+        'badgeHeight': badgeHeight,
+        'margin': margin,
+        'multiple': multiple,
+        'gutter': gutter,
+        'bleed': bleed,
+        'layout': layoutKind,
+        'placements': placements,
+        'neighbors': neighbors,
+        'usedBounds': usedBounds,
+        'boxWidth': usedBounds[2] - usedBounds[0],
+        'boxHeight': usedBounds[3] - usedBounds[1],
+        'waste': 1 - len(placements) * badgeWidth * badgeHeight / (sheetWidth * sheetHeight),
+        }
+
+def getPageMap(pages, sheet):
+    """
+    Where every badge ended up, for checking the print and sorting the cut badges.
+    """
+    pageMap = {
+        'sheetWidth': sheet['sheetWidth'],
+        'sheetHeight': sheet['sheetHeight'],
+        'badgeWidth': sheet['badgeWidth'],
+        'badgeHeight': sheet['badgeHeight'],
+        'layout': sheet['layout'],
+        'badgesPerSheet': len(sheet['placements']),
+        'waste': round(sheet['waste'], 4),
+        'pages': [],
+        }
+    for pageSlots in pages:
+        pageEntries = []
+        for (attendee, paletteId, patternId, bleedLeft, bleedRight), placement in zip(pageSlots, sheet['placements']):
+            pageEntries.append({
+                'firstName': attendee.firstName,
+                'lastName': attendee.lastName,
+                'company': attendee.company,
+                'copy': placement['copy'],
+                'x': placement['x'],
+                'y': placement['y'],
+                'width': placement['width'],
+                'height': placement['height'],
+                'rotated': placement['rotated'],
+                'palette': paletteId,
+                'pattern': patternId,
+                })
+        pageMap['pages'].append(pageEntries)
+    return pageMap
+
+def savePageMap(pageMapPath, pages, sheet):
+    with open(pageMapPath, 'w', encoding='utf-8') as pageMapFile:
+        json.dump(getPageMap(pages, sheet), pageMapFile, indent=1, ensure_ascii=False)
+
+## DESIGN ASSIGNMENT
+
+# Every copy of every badge gets its palette and pattern in one pass over the list,
+# before anything is drawn. Copies of the same attendee never share a palette or
+# pattern, neither do badges next to or on top of each other on a sheet, and among
+# what is left the least used choice wins, so the palettes are spread evenly. Ties
+# go by each badge's own order of preference, from a hash of the seed and who it
+# is for. The same seed and the same list always make the same badges.
+# The incremental rebuild passes in what every attendee had last time, and a badge
+# keeps that if it still fits, so adding a row does not reshuffle everyone after it.
+
+def getAttendeeKey(attendee, seenKeys):
+    """
+    Name an attendee in a way that stays the same between runs, counting
+    people who are in the list more than once under the same name and company.
+    """
+    attendeeKey = ' / '.join(part for part in ['%s %s' % (attendee.firstName, attendee.lastName), attendee.company] if part.strip())
+    seenKeys[attendeeKey] = seenKeys.get(attendeeKey, 0) + 1
+    if seenKeys[attendeeKey] > 1:
+        attendeeKey += ' #%s' % seenKeys[attendeeKey]
+    return attendeeKey
+
+def getDesignOrder(count, seed, attendeeKey, copyIndex, kind):
+    # the same badge always ranks the designs the same way
+    def rank(designId):
+        return hashlib.md5(json.dumps([seed, attendeeKey, copyIndex, kind, designId]).encode('utf-8')).hexdigest()
+    return sorted(range(count), key=rank)
+
+def pickDesign(designOrder, copyIds, neighborIds, useCounts, pinnedId=None):
+    # keep the design from last time, unless it now clashes
+    if pinnedId is not None and pinnedId < len(useCounts) and pinnedId not in copyIds | neighborIds:
+        return pinnedId
+    # loosen the rules until there is something to choose from
+    for excludedIds in [copyIds | neighborIds, copyIds, set()]:
+        candidateIds = [designId for designId in designOrder if designId not in excludedIds]
+        if candidateIds:
+            # min keeps the first of the least used, in the badge's own order
+            return min(candidateIds, key=lambda designId: useCounts[designId])
+
+def assignDesigns(attendees, cols=1, rows=1, multiple=1, seed=None, neighborSlots=None, pinnedDesigns=None):
+    """
+    Yield (attendee, paletteId, patternId) for every copy of every attendee, in the
+    order they are placed on the sheets, cols by rows badges to a sheet.
+    For other layouts, neighborSlots lists the earlier slots each slot touches,
+    one entry per slot on the sheet.
+    pinnedDesigns maps attendee keys to the [paletteId, patternId] of each copy
+    from an earlier run, to be kept where they still fit.
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    if pinnedDesigns is None:
+        pinnedDesigns = {}
+    paletteUses = [0] * len(paletteTable)
+    patternUses = [0] * len(patternText)
+    seenKeys = {}
+    # the palette and pattern of each slot on the current sheet, to check the neighbors
+    pageDesigns = []
+    # the badges of the attendee before, who is usually the one on top; each copy
+    # avoids the same copy before it even across a page break, so what a badge
+    # gets depends on the row before it rather than on where the page breaks fall
+    previousDesigns = []
+    for attendee in attendees:
+        attendeeKey = getAttendeeKey(attendee, seenKeys)
+        pinned = pinnedDesigns.get(attendeeKey, [])
+        copyPaletteIds = set()
+        copyPatternIds = set()
+        for m in range(multiple):
+            pinnedPaletteId, pinnedPatternId = pinned[m] if m < len(pinned) else (None, None)
+            if len(pageDesigns) == (len(neighborSlots) if neighborSlots else cols * rows):
+                pageDesigns = []
+            position = len(pageDesigns)
+            neighbors = previousDesigns[m:m+1]
+            if neighborSlots:
+                neighbors += [pageDesigns[neighborIndex] for neighborIndex in neighborSlots[position]]
+            else:
+                if position % cols:
+                    neighbors.append(pageDesigns[position - 1])
+                if position >= cols:
+                    neighbors.append(pageDesigns[position - cols])
+
+            paletteId = pickDesign(getDesignOrder(len(paletteTable), seed, attendeeKey, m, 'palette'), copyPaletteIds, set(neighbor[0] for neighbor in neighbors), paletteUses, pinnedPaletteId)
+            patternId = pickDesign(getDesignOrder(len(patternText), seed, attendeeKey, m, 'pattern'), copyPatternIds, set(neighbor[1] for neighbor in neighbors), patternUses, pinnedPatternId)
+            paletteUses[paletteId] += 1
+            patternUses[patternId] += 1
+            copyPaletteIds.add(paletteId)
+            copyPatternIds.add(patternId)
+            pageDesigns.append((paletteId, patternId))
+            yield attendee, paletteId, patternId
+        previousDesigns = pageDesigns[-multiple:]
+
+def paginateSheets(attendees, sheet, seed=None, pinnedDesigns=None):
+    """
+    Split the attendees into pages of badge slots, following the placements
+    of getSheetLayout, with the pattern and palette of every copy chosen by assignDesigns.
+    Pages are yielded as soon as they fill up, so the attendees can be a generator.
+    """
+    placements = sheet['placements']
+    slots = []
+    for attendee, paletteId, patternId in assignDesigns(attendees, multiple=sheet['multiple'], seed=seed, neighborSlots=sheet['neighbors'], pinnedDesigns=pinnedDesigns):
+        # bleed off the outside edges of the folded pair
+        placement = placements[len(slots)]
+        slots.append((attendee, paletteId, patternId, placement['bleedLeft'], placement['bleedRight']))
+        # if the page is full, start the next one
+        if len(slots) == len(placements):
+            yield slots
+            slots = []
+    if slots:
+        yield slots
+
+def drawSheetPage(pageSlots, sheet, badgePaths=None, layerPaths=None, badgePlans=None):
+    """
+    Draw one sheet of badges, from the slots made by paginateSheets.
+    If badgePaths are given, the badges are placed from those files instead of drawn.
+    If layerPaths are given, the backgrounds and patterns are placed from those files,
+    and only the names and companies are drawn.
+    If badgePlans are given, the names and companies are drawn from those layouts.
+    """
+    sheetWidth = sheet['sheetWidth']
+    sheetHeight = sheet['sheetHeight']
+    margin = sheet['margin']
+    usedBottom = sheet['usedBounds'][1]
 
-    #setup first page
     newPage(sheetWidth, sheetHeight)
     # fill the sheet with the background color, as a rudimentary bleed
-    
-    rect(0, sheetHeight-boxHeight-margin-margin, sheetWidth, boxHeight+margin*2)
-    # move to the top left corner, which is where we will start
-    translate(margin, sheetHeight-margin)
+    rect(0, usedBottom-margin, sheetWidth, sheetHeight-usedBottom+margin)
     # draw crop marks
-    drawCropMarks(rows, cols, boxWidth, boxHeight, badgeWidth, badgeHeight, margin)
-    # drop down to the bottom left corner to draw the badges
-    translate(0, -badgeHeight)
-
-    # loop through data
-    rowTick = 0
-    colTick = 0
-    for i, rowData in enumerate(data[:]):
-        firstName, lastName, company = parseRowData(rowData, colHeaders)
-
-        bleedLeft = 100
-        bleedRight = 0
-        prevColor = None
-        usedPatterns = []
-        usedColorPalettes = []
-        for m in range(multiple):
-            # draw the badge without setting the page size
-            
-            if colTick == 0:
-                bleedLeft = 100
-                bleedRight = 0
-            else:
-                bleedLeft = 0
-                bleedRight = 100
-                
-            
-            pattern = choice(patternText)*6
-            theColorPalette = colorPalettes[choice(list(colorPalettes.keys()))]
-            while pattern in usedPatterns:
-                pattern = choice(patternText)*6
-            while theColorPalette in usedColorPalettes:
-                theColorPalette = colorPalettes[choice(list(colorPalettes.keys()))]
-            usedPatterns.append(pattern)
-            usedColorPalettes.append(theColorPalette)
+    drawCropMarks(sheet)
 
+    for slotIndex, (attendee, paletteId, patternId, bleedLeft, bleedRight) in enumerate(pageSlots):
+        placement = sheet['placements'][slotIndex]
+        with savedState():
+            # move to the bottom left corner of the badge, and turn it if need be
+            if placement['rotated']:
+                translate(placement['x'] + placement['width'], placement['y'])
+                rotate(90)
+            else:
+                translate(placement['x'], placement['y'])
+            if badgePaths:
+                image(badgePaths[slotIndex], (-bleedLeft, 0))
+                continue
+            layers = None
+            if layerPaths:
+                image(layerPaths[slotIndex], (-bleedLeft, 0))
+                layers = ['name', 'company']
+            badgePlan = badgePlans[slotIndex] if badgePlans else {}
+            # draw the badge without setting the page size
             drawBadge(
-                w,
-                h,firstName,
-                lastName,
-                company,
+                sheet['w'],
+                sheet['h'],
+                attendee.firstName,
+                attendee.lastName,
+                attendee.company,
                 setSize=False,
                 phase=1,
                 bleedLeft=bleedLeft,
                 bleedRight=bleedRight,
-                colorPalette=theColorPalette,
-                pattern=pattern,
-                
+                colorPalette=paletteTable[paletteId],
+                pattern=patternText[patternId]*6,
+                layers=layers,
+                nameLayout=badgePlan.get('name'),
+                companyLayout=badgePlan.get('company'),
             )
-            translate(badgeWidth, 0)
-
-            # if we have made it to the last column, translate back and start the next one
-            if colTick == cols - 1:
-                translate(-badgeWidth*cols, 0)
-                translate(0, -badgeHeight)
-                colTick = 0
-
-
-                # if we have made it to the last row (and there is still more data), start a new page
-                if rowTick == rows - 1 and i != len(data) - 1:
-                    # setup a new page
-                    newPage(sheetWidth, sheetHeight)
-                    # fill the sheet with the background color, as a rudimentary bleed
-                    rect(0, sheetHeight-boxHeight-margin-margin, sheetWidth, boxHeight+margin*2)
-                    # move to the top left corner, which is where we will start
-                    translate(margin, sheetHeight-margin)
-                    # draw crop marks
-                    drawCropMarks(rows, cols, boxWidth, boxHeight, badgeWidth, badgeHeight, margin)
-                    # drop down to the bottom left corner to draw the badges
-                    translate(0, -badgeHeight)
-                    rowTick = 0
-                else:
-                    rowTick += 1
+
+def drawSheets(attendees, w, h, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, pattern=None, seed=None, pageStream=None, gutter=0, bleed=100, allowRotation=True, pageMapPath=None):
+    """
+    Make a sheet of badges for printing purposes.
+    If a pageStream is given, every sheet is written to disk as soon as it is drawn.
+    If a pageMapPath is given, the position of every badge is saved there as JSON.
+    """
+    sheet = getSheetLayout(w, h, sheetWidth, sheetHeight, badgeWidth, badgeHeight, margin, multiple, gutter, bleed, allowRotation)
+    pages = []
+    for pageSlots in paginateSheets(attendees, sheet, seed):
+        with profileStage('sheet'):
+            drawSheetPage(pageSlots, sheet)
+        if pageStream:
+            flushPage(pageStream)
+        if pageMapPath:
+            pages.append(pageSlots)
+    if pageMapPath:
+        savePageMap(pageMapPath, pages, sheet)
+
+## PARALLEL SHEETS
+
+# Each sheet only depends on its own slots, so pages can be drawn in separate
+# processes and stitched back together in order. This needs to be run with
+# python from the command line rather than inside the DrawBot app.
+
+def initializeSheetWorker(layoutCachePath, profilingEnabled, parentStart):
+    if layoutCachePath:
+        loadNameLayoutCache(layoutCachePath)
+    startWorkerProfile(profilingEnabled, parentStart)
+
+def renderSheetPageFile(pageIndex, pageSlots, sheet, pagePath):
+    # runs in a worker process, with a drawing of its own
+    knownLayouts = set(nameLayoutCache)
+    knownExceptions = set(linebreakExceptions)
+    newDrawing()
+    drawSheetPage(pageSlots, sheet)
+    with profileStage('saveImage'):
+        saveImage(pagePath)
+    endDrawing()
+    # hand back just the layouts this page added, so the parent can save them for next time
+    pageLayouts = dict((key, layout) for key, layout in nameLayoutCache.items() if key not in knownLayouts)
+    pageExceptions = OrderedDict((theName, reasons) for theName, reasons in linebreakExceptions.items() if theName not in knownExceptions)
+    return pageIndex, pagePath, pageLayouts, pageExceptions, takeWorkerProfile()
+
+def mergePagePDFs(pagePaths, outputPath, pageWidth, pageHeight):
+    """
+    Combine single page PDFs into one document, in the order given.
+    """
+    if PDFDocument is None:
+        # without PDFKit the pages are drawn into one drawing, which holds all of them in memory
+        newDrawing()
+        for pagePath in pagePaths:
+            newPage(pageWidth, pageHeight)
+            image(pagePath, (0, 0))
+        with profileStage('saveImage'):
+            saveImage(outputPath)
+        endDrawing()
+        return
+    # move the pages over as they are, so nothing is drawn again
+    with profileStage('saveImage'):
+        merged = PDFDocument.alloc().init()
+        for pagePath in pagePaths:
+            document = PDFDocument.alloc().initWithURL_(NSURL.fileURLWithPath_(pagePath))
+            if document is None:
+                raise IOError('could not read %s' % pagePath)
+            for pageIndex in range(document.pageCount()):
+                merged.insertPage_atIndex_(document.pageAtIndex_(pageIndex), merged.pageCount())
+        os.makedirs(os.path.dirname(os.path.abspath(outputPath)), exist_ok=True)
+        if not merged.writeToFile_(outputPath):
+            raise IOError('could not write %s' % outputPath)
+
+## STREAMING PAGES
+
+# A big attendee list makes a drawing hundreds of pages long, and all of it stays
+# in memory until saveImage. When streaming, each page is saved on its own as soon
+# as it is finished, and the pages are stitched together at the end.
+
+def startPageStream():
+    return {'dir': tempfile.mkdtemp(prefix='badgebot-pages-'), 'paths': []}
+
+def flushPage(pageStream):
+    # write the page we just drew to disk, and start over with an empty drawing
+    pagePath = os.path.join(pageStream['dir'], 'page-%05d.pdf' % len(pageStream['paths']))
+    with profileStage('saveImage'):
+        saveImage(pagePath)
+    endDrawing()
+    newDrawing()
+    pageStream['paths'].append(pagePath)
+
+def finishPageStream(pageStream, outputPath, pageWidth, pageHeight):
+    mergePagePDFs(pageStream['paths'], outputPath, pageWidth, pageHeight)
+    closePageStream(pageStream)
+
+def closePageStream(pageStream):
+    # safe to call more than once, so it can go in a finally after finishPageStream
+    shutil.rmtree(pageStream['dir'], ignore_errors=True)
+
+def drawSheetsParallel(attendees, w, h, outputPath, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, seed=None, processes=None, layoutCachePath=None, gutter=0, bleed=100, allowRotation=True, pageMapPath=None):
+    """
+    Make the same sheets as drawSheets, rendering the pages in a process pool,
+    and save them to outputPath.
+    """
+    sheet = getSheetLayout(w, h, sheetWidth, sheetHeight, badgeWidth, badgeHeight, margin, multiple, gutter, bleed, allowRotation)
+    # the patterns and palettes are chosen here, so the workers do not need the random state
+    pages = list(paginateSheets(attendees, sheet, seed))
+
+    pageDir = tempfile.mkdtemp(prefix='badgebot-pages-')
+    try:
+        jobs = []
+        for pageIndex, pageSlots in enumerate(pages):
+            jobs.append((pageIndex, pageSlots, sheet, os.path.join(pageDir, 'page-%05d.pdf' % pageIndex)))
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes, initializer=initializeSheetWorker, initargs=(layoutCachePath, profiling, profileStart)) as pool:
+            results = pool.starmap(renderSheetPageFile, jobs)
+
+        pagePaths = []
+        for pageIndex, pagePath, workerLayouts, workerExceptions, workerProfile in sorted(results, key=lambda result: result[0]):
+            pagePaths.append(pagePath)
+            nameLayoutCache.update(workerLayouts)
+            for theName, reasons in workerExceptions.items():
+                addLinebreakException(theName, reasons)
+            mergeWorkerProfile(workerProfile)
+
+        mergePagePDFs(pagePaths, outputPath, sheetWidth, sheetHeight)
+    finally:
+        shutil.rmtree(pageDir, ignore_errors=True)
+    if pageMapPath:
+        savePageMap(pageMapPath, pages, sheet)
+
+## INCREMENTAL REBUILDS
+
+# The attendee list gets exported over and over during conference week, but only
+# a few rows change each time. So every badge is saved on its own, named after a
+# fingerprint of everything that goes into it, and only missing badges are drawn.
+# The manifest remembers which badges each attendee had, for the summary, and
+# their designs, to keep for the next run. Badges nobody uses any more are deleted.
+badgeManifestVersion = 3
+
+def getBadgeFingerprint(slot, w, h):
+    attendee, paletteId, patternId, bleedLeft, bleedRight = slot
+    fontHashes = [getFileFingerprint(fontPath) for fontPath in allFonts]
+    badgeInputs = [
+        attendee.firstName, attendee.lastName, attendee.company,
+        paletteTable[paletteId], patternText[patternId],
+        w, h, bleedLeft, bleedRight, showCompany,
+        fontHashes,
+        # a new spelling or break in the overrides changes how the name is set
+        getFileFingerprint(nameOverridesPath),
+        # any change to the script itself invalidates everything
+        getFileFingerprint(os.path.abspath(__file__)),
+        ]
+    return hashlib.md5(json.dumps(badgeInputs).encode('utf-8')).hexdigest()
+
+def renderBadgeFile(slot, w, h, badgePath):
+    # draw one badge, bleeds and all, into a file of its own
+    attendee, paletteId, patternId, bleedLeft, bleedRight = slot
+    newDrawing()
+    newPage(w+bleedLeft+bleedRight, h)
+    translate(bleedLeft, 0)
+    drawBadge(
+        w,
+        h,
+        attendee.firstName,
+        attendee.lastName,
+        attendee.company,
+        setSize=False,
+        phase=1,
+        bleedLeft=bleedLeft,
+        bleedRight=bleedRight,
+        colorPalette=paletteTable[paletteId],
+        pattern=patternText[patternId]*6,
+    )
+    saveImage(badgePath)
+    endDrawing()
+
+def drawSheetsIncremental(attendees, w, h, outputPath, cacheDir, manifestPath, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, seed=0, gutter=0, bleed=100, allowRotation=True, pageMapPath=None):
+    """
+    Make the same sheets as drawSheets, but only draw the badges that have changed
+    since the last run, and save them to outputPath. The seed keeps the patterns
+    and palettes from changing between runs.
+    """
+    sheet = getSheetLayout(w, h, sheetWidth, sheetHeight, badgeWidth, badgeHeight, margin, multiple, gutter, bleed, allowRotation)
+    # the reused badges are never drawn, so their names are laid out here for the reports
+    attendees = list(attendees)
+    layoutAttendeeNames(attendees, w, h)
+
+    previousBadges = {}
+    previousDesigns = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath, 'r', encoding='utf-8') as manifestFile:
+            manifest = json.load(manifestFile)
+        if manifest.get('version') == badgeManifestVersion:
+            previousBadges = manifest['badges']
+            previousDesigns = manifest['designs']
+    # everyone keeps last run's design where it still fits, so their badges can be reused
+    pages = list(paginateSheets(attendees, sheet, seed, pinnedDesigns=previousDesigns))
+
+    os.makedirs(cacheDir, exist_ok=True)
+    currentBadges = {}
+    currentDesigns = {}
+    pageBadgePaths = []
+    renderedCount = 0
+    reusedCount = 0
+    seenKeys = {}
+    previousAttendee = None
+    for pageSlots in pages:
+        badgePaths = []
+        for slot in pageSlots:
+            # the copies of one attendee come one after the other
+            if slot[0] is not previousAttendee:
+                attendeeKey = getAttendeeKey(slot[0], seenKeys)
+                previousAttendee = slot[0]
+            fingerprint = getBadgeFingerprint(slot, w, h)
+            badgePath = os.path.join(cacheDir, fingerprint + '.pdf')
+            if os.path.exists(badgePath):
+                reusedCount += 1
             else:
-                colTick += 1
+                renderBadgeFile(slot, w, h, badgePath)
+                renderedCount += 1
+            badgePaths.append(badgePath)
+            currentBadges.setdefault(attendeeKey, []).append(fingerprint)
+            currentDesigns.setdefault(attendeeKey, []).append([slot[1], slot[2]])
+        pageBadgePaths.append(badgePaths)
+
+    # assemble the sheets from the saved badges
+    newDrawing()
+    for pageSlots, badgePaths in zip(pages, pageBadgePaths):
+        drawSheetPage(pageSlots, sheet, badgePaths=badgePaths)
+    saveImage(outputPath)
+    endDrawing()
+    if pageMapPath:
+        savePageMap(pageMapPath, pages, sheet)
+
+    # drop the badges of people who left the list, or whose badge changed
+    usedFiles = set(fingerprint + '.pdf' for fingerprints in currentBadges.values() for fingerprint in fingerprints)
+    prunedCount = 0
+    for fileName in os.listdir(cacheDir):
+        if fileName.endswith('.pdf') and fileName not in usedFiles:
+            os.remove(os.path.join(cacheDir, fileName))
+            prunedCount += 1
+
+    newAttendees = [attendeeKey for attendeeKey in currentBadges if attendeeKey not in previousBadges]
+    changedAttendees = [attendeeKey for attendeeKey in currentBadges if attendeeKey in previousBadges and previousBadges[attendeeKey] != currentBadges[attendeeKey]]
+    removedAttendees = [attendeeKey for attendeeKey in previousBadges if attendeeKey not in currentBadges]
+    print('rebuilt %s badges, reused %s, deleted %s' % (renderedCount, reusedCount, prunedCount))
+    print('new: %s' % (', '.join(newAttendees) or 'none'))
+    print('changed: %s' % (', '.join(changedAttendees) or 'none'))
+    print('removed: %s' % (', '.join(removedAttendees) or 'none'))
+
+    with open(manifestPath, 'w', encoding='utf-8') as manifestFile:
+        json.dump({'version': badgeManifestVersion, 'badges': currentBadges, 'designs': currentDesigns}, manifestFile, ensure_ascii=False, indent=1)
+
+## SHARED LAYERS
+
+# There are only so many palettes and patterns, so the same backgrounds come up
+# over and over on the sheets, and they are most of what is in the PDF. Here each
+# background and pattern is drawn once into a file of its own, like the layers of
+# the animation, and placed under every name that uses it, so the PDF can point
+# to one copy instead of holding one per badge. Everything goes into one document
+# rather than being stitched together from pages, because the fonts are subset
+# per document, and stitched pages would each bring their own subsets along.
+
+def getSharedLayerKey(slot):
+    attendee, paletteId, patternId, bleedLeft, bleedRight = slot
+    return paletteId, patternId, bleedLeft, bleedRight
+
+def renderSharedLayerFile(layerKey, w, h, layerPath):
+    # draw just the background and pattern, bleeds and all, into a file of its own
+    paletteId, patternId, bleedLeft, bleedRight = layerKey
+    newDrawing()
+    newPage(w+bleedLeft+bleedRight, h)
+    translate(bleedLeft, 0)
+    drawBadge(
+        w,
+        h,
+        '',
+        '',
+        '',
+        setSize=False,
+        phase=1,
+        bleedLeft=bleedLeft,
+        bleedRight=bleedRight,
+        colorPalette=paletteTable[paletteId],
+        pattern=patternText[patternId]*6,
+        layers=['background', 'pattern'],
+    )
+    saveImage(layerPath)
+    endDrawing()
+
+def drawSheetsShared(attendees, w, h, outputPath, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, seed=None, gutter=0, bleed=100, allowRotation=True, pageMapPath=None):
+    """
+    Make the same sheets as drawSheets, with every background and pattern drawn
+    once and shared by all the badges that use it, and save them to outputPath.
+    Prints the file size, and how long it took to get the first page out.
+    """
+    startTime = time.perf_counter()
+    sheet = getSheetLayout(w, h, sheetWidth, sheetHeight, badgeWidth, badgeHeight, margin, multiple, gutter, bleed, allowRotation)
+    pages = list(paginateSheets(attendees, sheet, seed))
+
+    # the layers have to be drawn before the sheets, since each one is a drawing of its own
+    layerDir = tempfile.mkdtemp(prefix='badgebot-layers-')
+    layerFiles = {}
+    pageLayerPaths = []
+    for pageSlots in pages:
+        layerPaths = []
+        for slot in pageSlots:
+            layerKey = getSharedLayerKey(slot)
+            if layerKey not in layerFiles:
+                layerFiles[layerKey] = os.path.join(layerDir, 'layer-%05d.pdf' % len(layerFiles))
+                with profileStage('layer'):
+                    renderSharedLayerFile(layerKey, w, h, layerFiles[layerKey])
+            layerPaths.append(layerFiles[layerKey])
+        pageLayerPaths.append(layerPaths)
+
+    newDrawing()
+    firstPageSeconds = None
+    for pageSlots, layerPaths in zip(pages, pageLayerPaths):
+        with profileStage('sheet'):
+            drawSheetPage(pageSlots, sheet, layerPaths=layerPaths)
+        if firstPageSeconds is None:
+            firstPageSeconds = time.perf_counter() - startTime
+    with profileStage('saveImage'):
+        saveImage(outputPath)
+    endDrawing()
+    shutil.rmtree(layerDir)
+    if pageMapPath:
+        savePageMap(pageMapPath, pages, sheet)
+
+    print('%s shared layers for %s badges' % (len(layerFiles), sum(len(pageSlots) for pageSlots in pages)))
+    print('first page after %.2fs, all %s pages after %.2fs, %.1f MB' % (
+        firstPageSeconds or 0, len(pages), time.perf_counter() - startTime, os.path.getsize(outputPath) / 1024 / 1024))
+
+## LAYOUT PLANS
+
+# All of the decisions about a badge, where it goes on the sheet, its palette and
+# pattern, how the name breaks and how big it is, and how wide the company bar is,
+# can be made without drawing anything. A plan is all of those decisions saved to
+# a JSON file, which can be drawn later, or somewhere else, or a few pages at a
+# time on several machines, without working any of it out again.
+planVersion = 3
+
+def getShownCompany(attendee):
+    # the company drawBadge puts on the badge, if any
+    if attendee.company.upper() == 'N/A' or not showCompany:
+        return None
+    return attendee.company or None
+
+def planBadge(attendee, w, h):
+    """
+    Lay out the name and company of one attendee, the same way drawBadge would.
+    """
+    patternFontSize = h/6
+    company = getShownCompany(attendee)
+    if company:
+        return {
+            'name': layoutName(attendee.firstName, attendee.lastName, w, h - patternFontSize),
+            'company': layoutCompany(company, companySize, w, patternFontSize),
+            }
+    return {
+        'name': layoutName(attendee.firstName, attendee.lastName, w, h),
+        'company': None,
+        }
+
+def getNameBatches(attendees, w, h):
+    # the names over a company have less room, so they are a batch of their own
+    withCompany = []
+    withoutCompany = []
+    for attendee in attendees:
+        if getShownCompany(attendee):
+            withCompany.append((attendee.firstName, attendee.lastName))
+        else:
+            withoutCompany.append((attendee.firstName, attendee.lastName))
+    return [(withCompany, w, h - h/6), (withoutCompany, w, h)]
+
+def layoutAttendeeNames(attendees, w, h):
+    """
+    Lay out every attendee’s name in one go with layoutNames, ready for drawing.
+    """
+    with profileStage('name layout'):
+        for names, boxWidth, boxHeight in getNameBatches(attendees, w, h):
+            layoutNames(names, boxWidth, boxHeight)
+
+def planSheets(attendees, w, h, planPath, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=None, badgeHeight=None, margin=.25*pt, multiple=2, seed=None, gutter=0, bleed=100, allowRotation=True):
+    """
+    Make the plan for the same sheets as drawSheets, and save it to planPath.
+    Each attendee is planned once, and the pages refer to them by index.
+    """
+    sheet = getSheetLayout(w, h, sheetWidth, sheetHeight, badgeWidth, badgeHeight, margin, multiple, gutter, bleed, allowRotation)
+    attendees = list(attendees)
+    layoutAttendeeNames(attendees, w, h)
+    attendeePlans = []
+    pages = []
+    for pageSlots in paginateSheets(attendees, sheet, seed):
+        pagePlan = []
+        for attendee, paletteId, patternId, bleedLeft, bleedRight in pageSlots:
+            # the copies of an attendee follow each other, so only the last one needs checking
+            if not attendeePlans or attendeePlans[-1]['attendee'] != list(attendee):
+                with profileStage('plan', '%s %s' % (attendee.firstName, attendee.lastName)):
+                    attendeePlans.append(dict(attendee=list(attendee), **planBadge(attendee, w, h)))
+            pagePlan.append([len(attendeePlans)-1, paletteId, patternId, bleedLeft, bleedRight])
+        pages.append(pagePlan)
+
+    plan = {
+        'version': planVersion,
+        'sheet': sheet,
+        'attendees': attendeePlans,
+        'pages': pages,
+        }
+    planDir = os.path.dirname(planPath)
+    if planDir:
+        os.makedirs(planDir, exist_ok=True)
+    with open(planPath, 'w', encoding='utf-8') as planFile:
+        json.dump(plan, planFile, ensure_ascii=False, separators=(',', ':'))
+    print('planned %s attendees on %s pages' % (len(attendeePlans), len(pages)))
+
+def loadPlan(planPath):
+    with open(planPath, 'r', encoding='utf-8') as planFile:
+        plan = json.load(planFile)
+    if plan.get('version') != planVersion:
+        raise ValueError('%s was planned by a different version of BadgeBot, plan it again' % planPath)
+    return plan
+
+def drawPlanSheets(plan, outputPath, firstPage=0, lastPage=None):
+    """
+    Draw the sheets of a plan, or the pages from firstPage up to lastPage, and save them to outputPath.
+    """
+    sheet = plan['sheet']
+    attendeePlans = plan['attendees']
+    newDrawing()
+    for pagePlan in plan['pages'][firstPage:lastPage]:
+        pageSlots = []
+        badgePlans = []
+        for attendeeIndex, paletteId, patternId, bleedLeft, bleedRight in pagePlan:
+            attendeePlan = attendeePlans[attendeeIndex]
+            pageSlots.append((Attendee(*attendeePlan['attendee']), paletteId, patternId, bleedLeft, bleedRight))
+            badgePlans.append(attendeePlan)
+        with profileStage('sheet'):
+            drawSheetPage(pageSlots, sheet, badgePlans=badgePlans)
+    with profileStage('saveImage'):
+        saveImage(outputPath)
+    endDrawing()
 
 ## READING DATA
 
@@ -626,20 +2519,297 @@ def readDataFromCSV(csvPath):
     """
     populate a list with rows from a csv file
     """
-    data = []
-    headers = None
+    return readHeadersFromCSV(csvPath), list(iterDataFromCSV(csvPath))
+
+def readHeadersFromCSV(csvPath):
+    """
+    get just the first row of a csv file
+    """
     with open(csvPath, 'r', encoding='utf-8') as csvfile:
         csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        for i, row in enumerate(csvreader):
-            if i != 0:
-                data.append(row)
-            else:
-                headers = row
+        return next(csvreader, None)
+
+def iterDataFromCSV(csvPath):
+    """
+    yield the rows of a csv file one at a time, skipping the headers
+    """
+    with open(csvPath, 'r', encoding='utf-8') as csvfile:
+        csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        next(csvreader, None)
+        for row in csvreader:
+            yield row
             #for char in row[1]:
             #    print(char, ord(char), unicodedata.name(char))
 
-    return headers, data
+def iterAttendeesFromCSV(csvPath, mapping=None, neededFields=()):
+    """
+    yield an Attendee for every row of a csv file
+    """
+    headerIndex = buildHeaderIndex(readHeadersFromCSV(csvPath), mapping, neededFields)
+    for row in iterDataFromCSV(csvPath):
+        yield parseRowData(row, headerIndex)
+
+def readAttendeesFromCSV(csvPath, mapping=None, neededFields=()):
+    """
+    populate a list with an Attendee for every row of a csv file
+    """
+    return list(iterAttendeesFromCSV(csvPath, mapping, neededFields))
+
+## PREFETCH
+
+# A cold run used to read the csv, then open each font the first time a badge
+# needed it, then draw, one thing after another. With PREFETCH, the fonts are read
+# with fontTools (metrics, kerning and fingerprints) and the name layout cache is
+# loaded in a few threads while the main thread reads the csv. At the end the
+# layout cache and the linebreak report are written in the background too.
+# That is all that moves: the csv, the name layouts, the drawing and saveImage
+# stay on the main thread, since DrawBot is not thread safe and the layouts are
+# python work that the threads would only take turns at. So it saves at most
+# the font and cache reads of a cold run, and nothing once the drawing starts.
+ioThreads = 4
+ioPool = None
+backgroundJobs = []
+
+def getIOPool():
+    global ioPool
+    if ioPool is None:
+        ioPool = ThreadPoolExecutor(ioThreads, thread_name_prefix='badgebot-io')
+    return ioPool
+
+def runInBackground(function, *args):
+    """
+    Run function in an I/O thread, and return its future.
+    waitForBackground collects it, along with any error it had.
+    """
+    future = getIOPool().submit(function, *args)
+    backgroundJobs.append(future)
+    return future
+
+def waitForBackground():
+    while backgroundJobs:
+        backgroundJobs.pop(0).result()
+
+def loadFontData(fontPath, variations=None):
+    # everything about a font that fontTools can tell us, without DrawBot
+    if os.path.exists(fontPath):
+        getFontMetrics(fontPath, variations)
+        getFontKerning(fontPath, variations)
+    getFileFingerprint(fontPath)
+
+def prefetchFonts():
+    """
+    Start reading every font the badges use, and return the futures.
+    """
+    fontJobs = [(fontPath, None) for fontPath in allFonts] + [(companyFont, companyVariations)]
+    return [runInBackground(loadFontData, fontPath, variations) for fontPath, variations in fontJobs]
+
+## OUTPUT FORMATS
+
+def drawSingleBadges(attendees, w, h, scaleValue=5, seed=None, pageStream=None):
+    """
+    Draw every badge on a page of its own, scaled up by scaleValue.
+    """
+    for i, (attendee, paletteId, patternId) in enumerate(assignDesigns(attendees, seed=seed)):
+
+        firstName, lastName, company = attendee.firstName, attendee.lastName, attendee.company
+
+        colorPalette = paletteTable[paletteId]
+        company = company.replace(' — ', ' ')
+        if company == firstName + ' ' + lastName:
+            company = ''
+
+        newPage(w*scaleValue, h*scaleValue)
+        scale(scaleValue, scaleValue)
+
+        drawBadge(
+            w,
+            h,
+            firstName,
+            lastName,
+            company,
+            setSize=False,
+            colorPalette=colorPalette,
+            pattern=patternText[patternId]*6,
+            )
+        if pageStream:
+            flushPage(pageStream)
+        #if i > 2:
+        #    break
+
+def drawScreenBadges(attendees, w=1920, h=1080, seed=None, pageStream=None):
+    """
+    Draw every badge on a 1920 x 1080 page, for showing on screens.
+    """
+    scaleValue = (1920/w)
+
+    for i, (attendee, paletteId, patternId) in enumerate(assignDesigns(attendees, seed=seed)):
+
+        firstName, lastName, company = attendee.firstName, attendee.lastName, attendee.company
+        colorPalette = paletteTable[paletteId]
+
+        newPage(1920, 1080)
+        scale(scaleValue, scaleValue)
+
+        drawBadge(
+            w,
+            h,
+            firstName,
+            lastName,
+            company,
+            setSize=False,
+            colorPalette=colorPalette,
+            pattern=patternText[patternId]*6,
+            )
+        if pageStream:
+            flushPage(pageStream)
+
+def drawBadgeAnimations(attendees, w, h, outputDir, seed=None, count=4):
+    """
+    Save an animated gif for each of the first count attendees to outputDir.
+    """
+    for i, (attendee, paletteId, patternId) in enumerate(assignDesigns(attendees, seed=seed)):
 
+        firstName, lastName, company = attendee.firstName, attendee.lastName, attendee.company
+        colorPalette = paletteTable[paletteId]
+
+        fullName = firstName+lastName
+        drawBadgeAnimation(
+            w,
+            h,
+            firstName,
+            lastName,
+            company,
+            os.path.join(outputDir, 'badgebot-output-animation-%s.gif' % fullName),
+            colorPalette=colorPalette,
+            pattern=patternText[patternId]*6,
+            totalFrames=30,
+            )
+        
+
+        if i >= count-1:
+            break
+
+## JOBS
+
+# For conference week there are several exports to draw (the full in-person list,
+# each day, the late additions) in several formats. Rather than editing FORMAT and
+# csvPath for each, list them as jobs in a json manifest, see jobs.example.json,
+# and run them all in one go. They run one after another in this process, so the
+# fonts, patterns and name layouts are shared between them, and each job gets a
+# folder of its own under output/.
+jobFormats = ['sheets', 'single', 'screen', 'raster', 'animation']
+requiredJobKeys = ['name', 'format', 'csv']
+
+def checkJob(job):
+    # the name becomes a folder under output/, so it may not point anywhere else
+    missingKeys = [key for key in requiredJobKeys if key not in job]
+    if missingKeys:
+        raise ValueError('job %s is missing %s' % (job.get('name', '(no name)'), ', '.join(missingKeys)))
+    jobName = job['name']
+    if not isinstance(jobName, str) or jobName in ['', '.', '..'] or '/' in jobName or '\\' in jobName or '\0' in jobName:
+        raise ValueError('job name %r should be a plain folder name, without slashes' % (jobName,))
+
+def runJob(job, manifestDir, outputDir, seed=None):
+    """
+    Read, filter and draw the attendees of one job from a manifest.
+    Returns how many attendees were drawn.
+    """
+    checkJob(job)
+    jobName = job['name']
+    jobFormat = job['format']
+    if jobFormat not in jobFormats:
+        raise ValueError('job %s has format %r, which should be one of %s' % (jobName, jobFormat, ', '.join(jobFormats)))
+    mapping = job.get('columnMapping', 'eventbrite')
+    if not isinstance(mapping, dict):
+        mapping = columnMappings[mapping]
+    seed = job.get('seed', seed)
+
+    csvPath = os.path.join(manifestDir, job['csv'])
+    excludeTicketTypes = job.get('excludeTicketTypes', [])
+    # without the ticket types the filter would let everyone through
+    neededFields = ['ticketType'] if excludeTicketTypes else []
+    attendees = list(filterAttendees(readAttendeesFromCSV(csvPath, mapping, neededFields), excludeTicketTypes=excludeTicketTypes))
+    jobDir = os.path.join(outputDir, jobName)
+    os.makedirs(jobDir, exist_ok=True)
+    preflightGlyphs(attendees, os.path.join(jobDir, 'badgebot-missing-glyphs.csv'), failOnMissing=failOnMissingGlyphs)
+
+    # these formats draw into one document; the rasters and animations open their own drawings
+    if jobFormat in ['sheets', 'single', 'screen']:
+        newDrawing()
+        try:
+            if jobFormat == 'sheets':
+                w = 4 * pt
+                h = 3 * pt
+                sheetWidth, sheetHeight = job.get('sheetSize', [8.5, 11])
+                layoutAttendeeNames(attendees, w, h)
+                drawSheets(attendees,
+                    w,
+                    h,
+                    sheetWidth = sheetWidth*pt,
+                    sheetHeight = sheetHeight*pt,
+                    badgeWidth = w,
+                    badgeHeight = h,
+                    margin = .25*pt,
+                    multiple=job.get('multiple', 2),
+                    seed=seed,
+                    gutter=job.get('gutter', 0),
+                    bleed=job.get('bleed', 100),
+                    pageMapPath=os.path.join(jobDir, 'badgebot-output-sheets-map.json'),
+                    )
+                with profileStage('saveImage'):
+                    saveImage(os.path.join(jobDir, 'badgebot-output-sheets.pdf'))
+            elif jobFormat == 'single':
+                drawSingleBadges(attendees, 4 * pt, 3 * pt, 5, seed=seed)
+                with profileStage('saveImage'):
+                    saveImage(os.path.join(jobDir, 'badgebot-output-single.pdf'))
+            elif jobFormat == 'screen':
+                drawScreenBadges(attendees, 1920, 1080, seed=seed)
+                with profileStage('saveImage'):
+                    saveImage(os.path.join(jobDir, 'badgebot-output-screen.pdf'))
+        finally:
+            endDrawing()
+    elif jobFormat == 'raster':
+        exportRasters(attendees, 1920, 1080, os.path.join(jobDir, 'badgebot-raster'), imageFormat='png', dpi=72, seed=seed)
+    elif jobFormat == 'animation':
+        drawBadgeAnimations(attendees, 1920, 1080, jobDir, seed=seed, count=job.get('count', 4))
+    return len(attendees)
+
+def runJobs(manifestPath, outputDir, seed=None):
+    """
+    Run every job in a manifest, and print how long each one took.
+    The csv paths in the manifest are relative to the manifest.
+    """
+    manifestDir = os.path.dirname(os.path.abspath(manifestPath))
+    with open(manifestPath, 'r', encoding='utf-8') as manifestFile:
+        jobs = json.load(manifestFile)['jobs']
+
+    # every job writes to a folder named after it, so two with one name would overwrite each other
+    # jobs without a usable name fail on their own in runJob
+    jobNames = [job.get('name') for job in jobs if isinstance(job.get('name'), str)]
+    duplicateNames = sorted(set(jobName for jobName in jobNames if jobNames.count(jobName) > 1))
+    if duplicateNames:
+        raise ValueError('more than one job is called %s' % ', '.join(duplicateNames))
+
+    jobTimings = []
+    for job in jobs:
+        jobName, jobFormat = job.get('name', '(no name)'), job.get('format', '')
+        print('running job %s (%s)' % (jobName, jobFormat))
+        start = time.perf_counter()
+        # one broken job should not stop the others
+        try:
+            attendeeCount = runJob(job, manifestDir, outputDir, seed)
+            result = 'ok'
+        except Exception as error:
+            traceback.print_exc()
+            attendeeCount = 0
+            result = 'failed: %s' % error
+        jobTimings.append((jobName, jobFormat, attendeeCount, time.perf_counter() - start, result))
+
+    print('%-32s %-10s %9s %9s  %s' % ('job', 'format', 'attendees', 'seconds', 'result'))
+    for jobName, jobFormat, attendeeCount, seconds, result in jobTimings:
+        print('%-32s %-10s %9s %9.2f  %s' % (jobName, jobFormat, attendeeCount, seconds, result))
+    failedCount = sum(1 for timing in jobTimings if timing[4] != 'ok')
+    print('%-32s %-10s %9s %9.2f  %s' % ('total', '', sum(timing[2] for timing in jobTimings), sum(timing[3] for timing in jobTimings), '%s failed' % failedCount if failedCount else 'ok'))
 
 if __name__ == "__main__":
 
@@ -649,8 +2819,27 @@ if __name__ == "__main__":
     #    "single" (single badge),
     #    "sheets" (3-up badges),
     #    "screen" (single, 1920 x 1080)
+    #    "raster" (png per attendee, 1920 x 1080, for kiosks and screens)
     #    "animation" (1920 x 1080) EXPERIMENTAL! GLITCHY! WATCH OUT! :)
+    #    "serve" (draw badges on request for walk-ups, see serveBadges)
+    #    "plan" (lay out the sheets without drawing, and save the plan as JSON)
+    #    "render-plan" (draw the sheets from a saved plan)
+    #    "jobs" (run every job in jobsPath, see runJobs)
     FORMAT = "sheets"
+    # draw the sheets in several processes at once (run from the command line)
+    PARALLEL = False
+    # set a number to make the same patterns and palettes every time
+    SEED = None
+    # read the csv and save the pages one at a time, for very long attendee lists
+    STREAMING = False
+    # only draw the sheet badges that changed since the last run
+    INCREMENTAL = False
+    # read the fonts and the layout cache in threads while the csv is read
+    PREFETCH = True
+    # draw each background and pattern once, and share it between the sheet badges
+    SHARED_LAYERS = False
+    # time each stage of the run, and print a report at the end
+    profiling = False
 
     # load data from a csv
     basePath = os.path.split(__file__)[0]
@@ -659,131 +2848,254 @@ if __name__ == "__main__":
     #csvPath = '/Users/david/Documents/Education/Clients/Typographics_Conference_2023_Attendee_Summary_Report_Excel_7366991467_20230609_1708.xlsx - Full in person attendee list.csv'
     #csvPath = '/Users/david/Documents/Education/Clients/Typographics_Conference_2023_Attendee_Summary_Report_Excel_7366991467_20230609_1708.xlsx - June 13–14.csv'
 
-    colHeaders, data = readDataFromCSV(csvPath)
-    
-    #data = data[24:25]
-    #data = data[0:30]
+    # which export the csv comes from, see columnMappings
+    columnMapping = columnMappings['eventbrite']
+
+    # the manifest for FORMAT = "jobs", with a csv, format and filters for each job
+    jobsPath = os.path.join(basePath, 'jobs.json')
+
+    # reuse the name fitting from previous runs
+    nameLayoutCachePath = os.path.join(basePath, 'output/.badgebot-name-layouts.json')
+    if PREFETCH:
+        fontJobs = prefetchFonts()
+        layoutCacheJob = runInBackground(loadNameLayoutCache, nameLayoutCachePath)
+
+    # the single badges leave out the livestream tickets, so the csv has to say which those are
+    neededFields = ['ticketType'] if FORMAT == "single" else []
+    if FORMAT in ["serve", "render-plan", "jobs"]:
+        # the attendees come in one request at a time, are already in the plan, or are read by each job
+        attendees = []
+    elif STREAMING:
+        attendees = iterAttendeesFromCSV(csvPath, neededFields=neededFields)
+    else:
+        attendees = readAttendeesFromCSV(csvPath, neededFields=neededFields)
 
+    if PREFETCH:
+        for fontJob in fontJobs:
+            fontJob.result()
 
-    if FORMAT == "sheets":
-        w = 4 * pt
-        h = 3 * pt
-        scaleValue = 5
+    if preloadFontsAtStartup:
+        preloadFonts()
 
-        # let's draw some sheets.
-        # Since we are not double-sided printing, we will print each twice, side-by-side,
-        # and fold along the middle.
-        colorPalette = colorPalettes[choice(list(colorPalettes.keys()))]
-        drawSheets(data,
-            w,
-            h,
-            sheetWidth = 8.5*pt,
-            sheetHeight = 11*pt,
-            badgeWidth = w,
-            badgeHeight = h,
-            margin = .25*pt,
-            multiple=2,
+    # check for missing glyphs before spending time drawing
+    if FORMAT not in ["serve", "render-plan", "jobs"]:
+        preflightGlyphs(
+            iterAttendeesFromCSV(csvPath) if STREAMING else attendees,
+            os.path.join(basePath, 'output/badgebot-missing-glyphs.csv'),
+            failOnMissing=failOnMissingGlyphs,
             )
 
-        os.makedirs('output', exist_ok=True)
-        saveImage(os.path.join(basePath, 'output/badgebot-output-sheets.pdf'))
+    if PREFETCH:
+        layoutCacheJob.result()
+    else:
+        loadNameLayoutCache(nameLayoutCachePath)
+    
+    #attendees = attendees[24:25]
+    #attendees = attendees[0:30]
 
-    elif FORMAT == "single":
-        w = 4 * pt
-        h = 3 * pt
-        scaleValue = 5
-        #random.shuffle(data)
 
-        for i, rowData in enumerate(data[:]):
+    # only these formats save their pages into one document
+    if STREAMING and FORMAT in ["sheets", "single", "screen"]:
+        pageStream = startPageStream()
+    else:
+        pageStream = None
 
-            firstName, lastName, company = parseRowData(rowData, colHeaders)
-            
-            if 'Livestream' in rowData[8]:
-                continue
+    try:
+        if FORMAT == "sheets":
+            w = 4 * pt
+            h = 3 * pt
+            scaleValue = 5
+
+            # let's draw some sheets.
+            # Since we are not double-sided printing, we will print each twice, side-by-side,
+            # and fold along the middle.
+            os.makedirs('output', exist_ok=True)
+            sheetsPath = os.path.join(basePath, 'output/badgebot-output-sheets.pdf')
+            # lay out all of the names at once, unless they are being read as we go
+            if PARALLEL and not STREAMING:
+                layoutAttendeeNames(attendees, w, h)
+                # the parallel workers pick the layouts up from the cache file
+                saveNameLayoutCache(nameLayoutCachePath)
+            elif not STREAMING:
+                layoutAttendeeNames(attendees, w, h)
+            # where each badge ended up, for the cutting
+            pageMapPath = os.path.join(basePath, 'output/badgebot-output-sheets-map.json')
+            # space between the folded pairs, and how far the pattern runs past the cut
+            gutter = 0
+            bleed = 100
+            if PARALLEL:
+                drawSheetsParallel(attendees,
+                    w,
+                    h,
+                    sheetsPath,
+                    sheetWidth = 8.5*pt,
+                    sheetHeight = 11*pt,
+                    badgeWidth = w,
+                    badgeHeight = h,
+                    margin = .25*pt,
+                    multiple=2,
+                    seed=SEED,
+                    layoutCachePath=nameLayoutCachePath,
+                    gutter=gutter,
+                    bleed=bleed,
+                    pageMapPath=pageMapPath,
+                    )
+            elif INCREMENTAL:
+                drawSheetsIncremental(attendees,
+                    w,
+                    h,
+                    sheetsPath,
+                    os.path.join(basePath, 'output/.badgebot-badges'),
+                    os.path.join(basePath, 'output/.badgebot-manifest.json'),
+                    sheetWidth = 8.5*pt,
+                    sheetHeight = 11*pt,
+                    badgeWidth = w,
+                    badgeHeight = h,
+                    margin = .25*pt,
+                    multiple=2,
+                    # the assignments have to be the same every run for the badges to match
+                    seed=SEED if SEED is not None else 0,
+                    gutter=gutter,
+                    bleed=bleed,
+                    pageMapPath=pageMapPath,
+                    )
+            elif SHARED_LAYERS:
+                drawSheetsShared(attendees,
+                    w,
+                    h,
+                    sheetsPath,
+                    sheetWidth = 8.5*pt,
+                    sheetHeight = 11*pt,
+                    badgeWidth = w,
+                    badgeHeight = h,
+                    margin = .25*pt,
+                    multiple=2,
+                    seed=SEED,
+                    gutter=gutter,
+                    bleed=bleed,
+                    pageMapPath=pageMapPath,
+                    )
+            else:
+                drawSheets(attendees,
+                    w,
+                    h,
+                    sheetWidth = 8.5*pt,
+                    sheetHeight = 11*pt,
+                    badgeWidth = w,
+                    badgeHeight = h,
+                    margin = .25*pt,
+                    multiple=2,
+                    seed=SEED,
+                    pageStream=pageStream,
+                    gutter=gutter,
+                    bleed=bleed,
+                    pageMapPath=pageMapPath,
+                    )
+                if pageStream:
+                    finishPageStream(pageStream, sheetsPath, 8.5*pt, 11*pt)
+                else:
+                    with profileStage('saveImage'):
+                        saveImage(sheetsPath)
 
-            colorPalette = colorPalettes[choice(list(colorPalettes.keys()))]
-            company = company.replace(' — ', ' ')
-            if company == firstName + ' ' + lastName:
-                company = ''
+        elif FORMAT == "single":
+            w = 4 * pt
+            h = 3 * pt
+            scaleValue = 5
+            #random.shuffle(data)
 
-            newPage(w*scaleValue, h*scaleValue)
-            scale(scaleValue, scaleValue)
+            drawSingleBadges(filterAttendees(attendees, excludeTicketTypes=['Livestream']), w, h, scaleValue, seed=SEED, pageStream=pageStream)
 
-            drawBadge(
-                w,
-                h,
-                firstName,
-                lastName,
-                company,
-                setSize=False,
-                colorPalette=colorPalette
-                )
-            #if i > 2:
-            #    break
+            singlePath = os.path.join(basePath, 'output/badgebot-output-single.pdf')
+            if pageStream:
+                finishPageStream(pageStream, singlePath, w*scaleValue, h*scaleValue)
+            else:
+                with profileStage('saveImage'):
+                    saveImage(singlePath)
 
-        saveImage(os.path.join(basePath, 'output/badgebot-output-single.pdf'))
+        elif FORMAT == "screen":
+            w = 1920
+            h = 1080
 
-    elif FORMAT == "screen":
-        w = 1920
-        h = 1080
-        scaleValue = (1920/w)
+            drawScreenBadges(itertools.islice(attendees, 1, None), w, h, seed=SEED, pageStream=pageStream)
 
-        for i, rowData in enumerate(data[1:]):
+            screenPath = os.path.join(basePath, 'output/badgebot-output-screen.pdf')
+            if pageStream:
+                finishPageStream(pageStream, screenPath, 1920, 1080)
+            else:
+                with profileStage('saveImage'):
+                    saveImage(screenPath)
 
-            firstName, lastName, company = parseRowData(rowData, colHeaders)
+        elif FORMAT == "serve":
+            serveBadges()
 
-            newPage(1920, 1080)
-            scale(scaleValue, scaleValue)
+        elif FORMAT == "jobs":
+            runJobs(jobsPath, os.path.join(basePath, 'output'), seed=SEED)
 
-            drawBadge(
+        elif FORMAT == "plan":
+            w = 4 * pt
+            h = 3 * pt
+            planSheets(attendees,
                 w,
                 h,
-                firstName,
-                lastName,
-                company,
-                setSize=False,
-                pointSize=200
+                os.path.join(basePath, 'output/badgebot-plan.json'),
+                sheetWidth = 8.5*pt,
+                sheetHeight = 11*pt,
+                badgeWidth = w,
+                badgeHeight = h,
+                margin = .25*pt,
+                multiple=2,
+                seed=SEED,
                 )
 
-        saveImage(os.path.join(basePath, 'output/badgebot-output-screen.pdf'))
-
-    elif FORMAT == "animation":
-        w = 1920
-        h = 1080
-        scaleValue = (1920/w)
-
-        for i, rowData in enumerate(data[1:]):
-
-            firstName, lastName, company = parseRowData(rowData, colHeaders)
-
-            newDrawing()
-            size(1920, 1080)
-
-            totalFrames = 30
-            for f in range(totalFrames):
-                frameDuration(1/30)
-
-                if not f == 0:
-                    newPage()
-
-                scale(scaleValue, scaleValue)
+        elif FORMAT == "render-plan":
+            # set the first and last page to split the drawing between machines
+            drawPlanSheets(
+                loadPlan(os.path.join(basePath, 'output/badgebot-plan.json')),
+                os.path.join(basePath, 'output/badgebot-output-sheets.pdf'),
+                firstPage=0,
+                lastPage=None,
+                )
 
-                drawBadge(
-                    w,
-                    h,
-                    firstName,
-                    lastName,
-                    company,
-                    setSize=False,
-                    pointSize=220,
-                    phase=f/totalFrames
-                    )
+        elif FORMAT == "raster":
+            w = 1920
+            h = 1080
 
-            fullName = firstName+lastName
-            saveImage(os.path.join(basePath, 'output/badgebot-output-animation-%s.gif' % fullName))
-            
+            exportRasters(
+                attendees,
+                w,
+                h,
+                os.path.join(basePath, 'output/badgebot-raster'),
+                imageFormat='png',
+                dpi=72,
+                seed=SEED,
+                )
 
-            if i > 2:
-                break
+        elif FORMAT == "animation":
+            w = 1920
+            h = 1080
+
+            drawBadgeAnimations(itertools.islice(attendees, 1, None), w, h, os.path.join(basePath, 'output'), seed=SEED, count=4)
+    finally:
+        # a run that fails part way should not leave its pages behind
+        if pageStream:
+            closePageStream(pageStream)
+
+    # the background layouts have to be finished before the cache is saved
+    waitForBackground()
+    if PREFETCH:
+        runInBackground(saveNameLayoutCache, nameLayoutCachePath)
+        runInBackground(saveLinebreakExceptions, os.path.join(basePath, 'output/badgebot-linebreak-exceptions.csv'))
+    else:
+        saveNameLayoutCache(nameLayoutCachePath)
+        saveLinebreakExceptions(os.path.join(basePath, 'output/badgebot-linebreak-exceptions.csv'))
+    # overrides nobody needed are probably left over from last year
+    if FORMAT != "serve":
+        for table, key in getUnusedNameOverrides():
+            print('unused name override in %s: %r' % (table, key))
+
+    if profiling:
+        printProfileReport()
+        saveProfileTrace(os.path.join(basePath, 'output/badgebot-profile-trace.json'))
+    waitForBackground()
 
 print('\n\n'.join(linebreakExceptions))
\ No newline at end of file
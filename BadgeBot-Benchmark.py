@@ -0,0 +1,353 @@
+# coding: utf-8
+"""
+##################
+BadgeBot Benchmark
+##################
+
+Time the badge drawing hot paths with made-up attendees.
+
+Run this from the command line, next to BadgeBot-2023.py:
+
+    python BadgeBot-Benchmark.py                 # 100, 1000 and 10000 attendees
+    python BadgeBot-Benchmark.py 100 500         # just these sizes
+    python BadgeBot-Benchmark.py --compare output/benchmarks/benchmark-abc1234.json
+    python BadgeBot-Benchmark.py --shared 100    # also compare SHARED_LAYERS to plain sheets
+    python BadgeBot-Benchmark.py --animation 100 # also time the layered animation against whole frames
+
+It needs the drawBot module, which runs on macOS (pip install
+git+https://github.com/typemytype/drawbot). There is no headless run on linux:
+drawbot-skia has no FormattedString or textBox, which the badges are made of. Each size runs in a process of its
+own, so the memory numbers are for that size alone. Results are saved as JSON
+in output/benchmarks, so runs can be compared across commits.
+"""
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+basePath = os.path.split(os.path.abspath(__file__))[0]
+badgeBotPath = os.path.join(basePath, 'BadgeBot-2023.py')
+resultsDir = os.path.join(basePath, 'output/benchmarks')
+
+# the functions we want to see in the report
+timedFunctions = ['drawSheets', 'drawBadge', 'drawName', 'layoutName', 'drawCompany', 'getPatternPath', 'saveImage']
+
+defaultSizes = [100, 1000, 10000]
+
+
+## BACKEND
+
+def loadBadgeBot():
+    """
+    Import BadgeBot-2023.py as a module.
+    """
+    try:
+        import drawBot
+    except ImportError:
+        sys.exit('the benchmark needs the drawBot module, which only runs on macOS')
+    spec = importlib.util.spec_from_file_location('badgebot', badgeBotPath)
+    badgeBot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(badgeBot)
+    return badgeBot
+
+
+## SYNTHETIC ATTENDEES
+
+# a mix of the names that make drawName work hardest
+shortFirstNames = ['Al', 'Bo', 'Jo', 'Li', 'Ed']
+shortLastNames = ['Ng', 'Wu', 'Oz', 'Le', 'Yi']
+firstNames = ['Tamara', 'Christopher', 'Nick', 'David', 'Jennifer', 'Tobias', 'Juliet']
+lastNames = ['Sherman', 'Ross', 'Tinizaray', 'Jörger', 'Stössinger', 'McDonald', 'Frere-Jones']
+hyphenatedNames = ['Jean-Luc', 'Smith-Jones', 'Anne-Marie', 'Lloyd-Webber']
+multiWordFirstNames = ['Mary Kate', 'José María', 'Anna Sophia']
+multiWordLastNames = ['Van Der Berg', 'De La Cruz', 'Dos Santos']
+nonASCIINames = ['Zoë', 'Łukasz', 'Søren', 'Ñúñez', 'Åsa', 'Dvořák', 'Çelik']
+companies = ['Acme', 'N/A', '', 'Type Foundry', 'Studio — Design', 'University of Texas at Austin School of Design and Creative Technologies']
+longCompanies = ['The Extremely Long Name of a Typographic Research Consortium', 'International Federation of Lettering Arts and Calligraphic Societies']
+
+def makeAttendees(badgeBot, count, seed=0):
+    """
+    Make count attendees, cycling through the kinds of names we want to cover.
+    """
+    rng = random.Random(seed)
+    kinds = [
+        lambda: (rng.choice(shortFirstNames), rng.choice(shortLastNames), rng.choice(companies)),
+        lambda: (rng.choice(firstNames), rng.choice(lastNames), rng.choice(companies)),
+        lambda: (rng.choice(hyphenatedNames), rng.choice(lastNames + hyphenatedNames), rng.choice(companies)),
+        lambda: (rng.choice(multiWordFirstNames), rng.choice(multiWordLastNames), rng.choice(companies)),
+        lambda: (rng.choice(firstNames), rng.choice(lastNames), rng.choice(longCompanies)),
+        lambda: (rng.choice(nonASCIINames), rng.choice(nonASCIINames + lastNames), rng.choice(companies)),
+        ]
+    attendees = []
+    for i in range(count):
+        firstName, lastName, company = kinds[i % len(kinds)]()
+        attendees.append(badgeBot.Attendee(firstName, lastName, company, 'In Person'))
+    return attendees
+
+
+## TIMING
+
+def instrument(badgeBot, functionNames, timings):
+    """
+    Swap the module’s functions for versions that add up their calls and time.
+    The times include any timed functions they call.
+    """
+    for functionName in functionNames:
+        original = getattr(badgeBot, functionName)
+        timings[functionName] = {'calls': 0, 'seconds': 0.0}
+
+        def makeTimed(original, functionName):
+            @wraps(original)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    timings[functionName]['calls'] += 1
+                    timings[functionName]['seconds'] += time.perf_counter() - start
+            return timed
+        setattr(badgeBot, functionName, makeTimed(original, functionName))
+
+def resetCaches(badgeBot):
+    # every size starts cold, so the numbers are comparable
+    badgeBot.patternCache.clear()
+    badgeBot.nameLayoutCache.clear()
+    badgeBot.companyLayoutCache.clear()
+    badgeBot.linebreakExceptions.clear()
+
+def runBenchmark(badgeBot, count, multiple=2):
+    timings = {}
+    originals = dict((functionName, getattr(badgeBot, functionName)) for functionName in timedFunctions)
+    instrument(badgeBot, timedFunctions, timings)
+    attendees = makeAttendees(badgeBot, count)
+    resetCaches(badgeBot)
+
+    pt = badgeBot.pt
+    w = 4 * pt
+    h = 3 * pt
+    outputPath = os.path.join(resultsDir, 'benchmark-sheets.pdf')
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    badgeBot.newDrawing()
+    badgeBot.drawSheets(attendees, w, h, sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=w, badgeHeight=h, margin=.25*pt, multiple=multiple, seed=0)
+    badgeBot.saveImage(outputPath)
+    badgeBot.endDrawing()
+    seconds = time.perf_counter() - start
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    for functionName, original in originals.items():
+        setattr(badgeBot, functionName, original)
+    os.remove(outputPath)
+
+    return {
+        'attendees': count,
+        'badges': count * multiple,
+        'seconds': seconds,
+        'badgesPerSecond': count * multiple / seconds,
+        'peakPythonMemory': peakMemory,
+        # the peak of the whole process, which only ran this size
+        'maxRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'functions': timings,
+        }
+
+def runBenchmarkProcess(count):
+    """
+    Run one size in a fresh python, so its memory peak is not left over from a bigger size.
+    """
+    resultsFile, resultsPath = tempfile.mkstemp(suffix='.json')
+    os.close(resultsFile)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--run', str(count), resultsPath])
+        with open(resultsPath, 'r', encoding='utf-8') as runFile:
+            return json.load(runFile)
+    finally:
+        os.remove(resultsPath)
+
+def compareSharedLayers(badgeBot, count, multiple=2):
+    """
+    Draw the same attendees with drawSheets and with drawSheetsShared, and
+    compare the files: the pages should match, and the shared file should be smaller.
+    """
+    attendees = makeAttendees(badgeBot, count)
+    pt = badgeBot.pt
+    w = 4 * pt
+    h = 3 * pt
+    sheetOptions = dict(sheetWidth=8.5*pt, sheetHeight=11*pt, badgeWidth=w, badgeHeight=h, margin=.25*pt, multiple=multiple, seed=0)
+    plainPath = os.path.join(resultsDir, 'benchmark-plain.pdf')
+    sharedPath = os.path.join(resultsDir, 'benchmark-shared.pdf')
+
+    resetCaches(badgeBot)
+    start = time.perf_counter()
+    badgeBot.newDrawing()
+    badgeBot.drawSheets(attendees, w, h, **sheetOptions)
+    badgeBot.saveImage(plainPath)
+    badgeBot.endDrawing()
+    plainSeconds = time.perf_counter() - start
+
+    resetCaches(badgeBot)
+    start = time.perf_counter()
+    badgeBot.drawSheetsShared(attendees, w, h, sharedPath, **sheetOptions)
+    sharedSeconds = time.perf_counter() - start
+
+    comparison = {'attendees': count}
+    for kind, path, seconds in [('plain', plainPath, plainSeconds), ('shared', sharedPath, sharedSeconds)]:
+        comparison[kind] = {'bytes': os.path.getsize(path), 'pages': badgeBot.numberOfPages(path), 'seconds': seconds}
+        os.remove(path)
+    return comparison
+
+def printSharedComparison(comparison):
+    plain, shared = comparison['plain'], comparison['shared']
+    print('%s attendees, shared layers: %s pages, %.1f MB in %.2fs, against %s pages, %.1f MB in %.2fs (%+.1f%% size)' % (
+        comparison['attendees'],
+        shared['pages'], shared['bytes'] / 1024 / 1024, shared['seconds'],
+        plain['pages'], plain['bytes'] / 1024 / 1024, plain['seconds'],
+        (shared['bytes'] - plain['bytes']) / plain['bytes'] * 100))
+    if shared['pages'] != plain['pages']:
+        print('    the page counts do not match!')
+
+def compareAnimation(badgeBot, count=4, totalFrames=30):
+    """
+    Save count animated badges at 1920 x 1080 with drawBadgeAnimation, and again
+    the old way, drawing the whole badge on every frame, and time both.
+    """
+    w, h = 1920, 1080
+    designs = list(badgeBot.assignDesigns(makeAttendees(badgeBot, count), seed=0))
+    gifPath = os.path.join(resultsDir, 'benchmark-animation.gif')
+
+    resetCaches(badgeBot)
+    start = time.perf_counter()
+    for attendee, paletteId, patternId in designs:
+        badgeBot.newDrawing()
+        for f in range(totalFrames):
+            badgeBot.newPage(w, h)
+            badgeBot.frameDuration(1/totalFrames)
+            badgeBot.drawBadge(w, h, attendee.firstName, attendee.lastName, attendee.company, setSize=False, colorPalette=badgeBot.paletteTable[paletteId], pattern=badgeBot.patternText[patternId]*6, phase=f/totalFrames)
+        badgeBot.saveImage(gifPath)
+        badgeBot.endDrawing()
+    wholeSeconds = time.perf_counter() - start
+
+    resetCaches(badgeBot)
+    start = time.perf_counter()
+    for attendee, paletteId, patternId in designs:
+        badgeBot.drawBadgeAnimation(w, h, attendee.firstName, attendee.lastName, attendee.company, gifPath, colorPalette=badgeBot.paletteTable[paletteId], pattern=badgeBot.patternText[patternId]*6, totalFrames=totalFrames)
+    layeredSeconds = time.perf_counter() - start
+    os.remove(gifPath)
+
+    return {
+        'animations': count,
+        'frames': count * totalFrames,
+        'wholeSeconds': wholeSeconds,
+        'layeredSeconds': layeredSeconds,
+        }
+
+def printAnimationComparison(comparison):
+    print('%s animations, %s frames: layered %.2fs (%.3fs a frame), whole frames %.2fs (%.3fs a frame), %.1fx faster' % (
+        comparison['animations'], comparison['frames'],
+        comparison['layeredSeconds'], comparison['layeredSeconds'] / comparison['frames'],
+        comparison['wholeSeconds'], comparison['wholeSeconds'] / comparison['frames'],
+        comparison['wholeSeconds'] / comparison['layeredSeconds']))
+
+
+## REPORTING
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=basePath, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def printRun(run, previousRun=None):
+    print('%s attendees: %.2fs, %.1f badges/s, peak python memory %.1f MB' % (
+        run['attendees'], run['seconds'], run['badgesPerSecond'], run['peakPythonMemory'] / 1024 / 1024))
+    if previousRun:
+        change = (run['seconds'] - previousRun['seconds']) / previousRun['seconds'] * 100
+        print('    %+.1f%% compared to before' % change)
+    for functionName in timedFunctions:
+        timing = run['functions'][functionName]
+        line = '    %-16s %8s calls %10.3fs' % (functionName, timing['calls'], timing['seconds'])
+        if previousRun and functionName in previousRun['functions']:
+            line += '  (was %.3fs)' % previousRun['functions'][functionName]['seconds']
+        print(line)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['--run']:
+        # one size, started by runBenchmarkProcess
+        count, resultsPath = int(args[1]), args[2]
+        badgeBot = loadBadgeBot()
+        with open(resultsPath, 'w', encoding='utf-8') as runFile:
+            json.dump(runBenchmark(badgeBot, count), runFile)
+        sys.exit()
+
+    comparePath = None
+    if '--compare' in args:
+        comparePath = args[args.index('--compare') + 1]
+        args.remove(comparePath)
+        args.remove('--compare')
+    compareShared = '--shared' in args
+    if compareShared:
+        args.remove('--shared')
+    compareAnimations = '--animation' in args
+    if compareAnimations:
+        args.remove('--animation')
+    sizes = [int(arg) for arg in args] or defaultSizes
+
+    previousRuns = {}
+    if comparePath:
+        with open(comparePath, 'r', encoding='utf-8') as previousFile:
+            for previousRun in json.load(previousFile)['runs']:
+                previousRuns[previousRun['attendees']] = previousRun
+
+    os.makedirs(resultsDir, exist_ok=True)
+    # fail here, rather than once for every size
+    loadBadgeBot()
+    commit = getCommit()
+    print('benchmarking %s' % commit)
+
+    runs = []
+    for count in sizes:
+        run = runBenchmarkProcess(count)
+        printRun(run, previousRuns.get(count))
+        runs.append(run)
+
+    sharedComparisons = []
+    if compareShared:
+        badgeBot = loadBadgeBot()
+        for count in sizes:
+            comparison = compareSharedLayers(badgeBot, count)
+            printSharedComparison(comparison)
+            sharedComparisons.append(comparison)
+
+    animationComparison = None
+    if compareAnimations:
+        # every animation is the same amount of drawing, so the sizes do not matter here
+        animationComparison = compareAnimation(loadBadgeBot())
+        printAnimationComparison(animationComparison)
+
+    results = {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'runs': runs,
+        'sharedLayers': sharedComparisons,
+        'animation': animationComparison,
+        }
+    resultsPath = os.path.join(resultsDir, 'benchmark-%s.json' % commit)
+    with open(resultsPath, 'w', encoding='utf-8') as resultsFile:
+        json.dump(results, resultsFile, indent=1)
+    print('saved', resultsPath)
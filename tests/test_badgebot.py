@@ -0,0 +1,346 @@
+# coding: utf-8
+"""
+Tests for BadgeBot. The script is loaded as a module, so DrawBot has to be importable.
+"""
+import importlib.util
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+pytest.importorskip('drawBot')
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def makeFont(fontPath, characters, featureText=None):
+    """
+    Save a small font with a square glyph for each of the characters.
+    """
+    from fontTools.fontBuilder import FontBuilder
+    from fontTools.pens.ttGlyphPen import TTGlyphPen
+    glyphNames = ['.notdef', 'space'] + list(characters)
+    fontBuilder = FontBuilder(1000, isTTF=True)
+    fontBuilder.setupGlyphOrder(glyphNames)
+    characterMap = {32: 'space'}
+    characterMap.update((ord(character), character) for character in characters)
+    fontBuilder.setupCharacterMap(characterMap)
+    glyphs = {}
+    for glyphName in glyphNames:
+        pen = TTGlyphPen(None)
+        if glyphName != 'space':
+            pen.moveTo((0, 0))
+            pen.lineTo((0, 700))
+            pen.lineTo((500, 700))
+            pen.closePath()
+        glyphs[glyphName] = pen.glyph()
+    fontBuilder.setupGlyf(glyphs)
+    fontBuilder.setupHorizontalMetrics(dict((glyphName, (600, 0)) for glyphName in glyphNames))
+    fontBuilder.setupHorizontalHeader(ascent=800, descent=-200)
+    fontBuilder.setupNameTable({'familyName': 'Badge Test', 'styleName': 'Regular'})
+    fontBuilder.setupOS2(sCapHeight=700, sTypoAscender=800)
+    fontBuilder.setupPost()
+    if featureText:
+        fontBuilder.addOpenTypeFeatures(featureText)
+    fontBuilder.save(fontPath)
+    return fontPath
+
+
+@pytest.fixture(scope='module')
+def badgebot():
+    spec = importlib.util.spec_from_file_location('badgebot', os.path.join(repoPath, 'BadgeBot-2023.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def makeAttendees(badgebot, count):
+    return [badgebot.Attendee('First%s' % i, 'Last%s' % (i % 17), 'Company %s' % (i % 5), 'General') for i in range(count)]
+
+
+def getSheet(badgebot):
+    w, h = 4 * badgebot.pt, 3 * badgebot.pt
+    return badgebot.getSheetLayout(w, h, 8.5 * badgebot.pt, 11 * badgebot.pt, w, h, .25 * badgebot.pt, 2, 0, 100, True)
+
+
+## SHEET FUNCTIONS
+
+@pytest.mark.parametrize('sheetSize, badgeSize', [((8.5, 11), (4, 3)), ((12, 18), (4, 3)), ((11, 17), (3.5, 2.25)), ((10, 12), (3, 2))])
+def testCropMarksNeverPointThroughABadge(badgebot, monkeypatch, sheetSize, badgeSize):
+    pt = badgebot.pt
+    w, h = badgeSize[0] * pt, badgeSize[1] * pt
+    sheet = badgebot.getSheetLayout(w, h, sheetSize[0] * pt, sheetSize[1] * pt, w, h, .25 * pt, 2, 0, 100, True)
+    marks = []
+    monkeypatch.setattr(badgebot, 'line', lambda start, end: marks.append((start, end)))
+    badgebot.drawCropMarks(sheet)
+
+    usedLeft, usedBottom, usedRight, usedTop = sheet['usedBounds']
+    edges = [(p['x'], p['y'], p['x'] + p['width'], p['y'] + p['height']) for p in sheet['placements']]
+    assert marks
+    for (x, y), end in marks:
+        # the badges along the edge the mark is on must not be cut through by it
+        if x < usedLeft:
+            crossed = [edge for edge in edges if abs(edge[0] - usedLeft) < .01 and edge[1] + .01 < y < edge[3] - .01]
+        elif x > usedRight:
+            crossed = [edge for edge in edges if abs(edge[2] - usedRight) < .01 and edge[1] + .01 < y < edge[3] - .01]
+        elif y > usedTop:
+            crossed = [edge for edge in edges if abs(edge[3] - usedTop) < .01 and edge[0] + .01 < x < edge[2] - .01]
+        else:
+            crossed = [edge for edge in edges if abs(edge[1] - usedBottom) < .01 and edge[0] + .01 < x < edge[2] - .01]
+        assert not crossed
+
+
+## DESIGN ASSIGNMENT
+
+def testInsertedRowOnlyRedrawsItsNeighbors(badgebot, tmp_path, monkeypatch):
+    # the incremental run only draws the badges it has no file for
+    sheet = getSheet(badgebot)
+    attendees = makeAttendees(badgebot, 120)
+    renderBadgeFile = badgebot.renderBadgeFile
+    rendered = []
+
+    def recordRender(slot, w, h, badgePath):
+        rendered.append(slot[0])
+        renderBadgeFile(slot, w, h, badgePath)
+    monkeypatch.setattr(badgebot, 'renderBadgeFile', recordRender)
+
+    def drawIncremental(attendees):
+        del rendered[:]
+        badgebot.drawSheetsIncremental(attendees, sheet['w'], sheet['h'], str(tmp_path / 'sheets.pdf'), str(tmp_path / 'badges'), str(tmp_path / 'manifest.json'), badgeWidth=sheet['w'], badgeHeight=sheet['h'], seed=0)
+        return list(rendered)
+
+    assert len(drawIncremental(attendees)) == len(attendees) * sheet['multiple']
+    insertAt = 50
+    newcomer = badgebot.Attendee('New', 'Person', 'Elsewhere', 'General')
+    redrawn = drawIncremental(attendees[:insertAt] + [newcomer] + attendees[insertAt:])
+    # the new badges, and at most the attendee after them, who may have to move off their design
+    assert newcomer in redrawn
+    assert set(redrawn) <= {newcomer, attendees[insertAt]}
+
+
+def testReusedBadgesStillReportTheirLinebreaks(badgebot, tmp_path, monkeypatch):
+    sheet = getSheet(badgebot)
+    attendees = [badgebot.Attendee('Mary-Jane', 'Watson', 'Daily Bugle', 'General')] + makeAttendees(badgebot, 5)
+    monkeypatch.setattr(badgebot, 'linebreakExceptions', badgebot.OrderedDict())
+
+    def drawIncremental():
+        badgebot.drawSheetsIncremental(attendees, sheet['w'], sheet['h'], str(tmp_path / 'sheets.pdf'), str(tmp_path / 'badges'), str(tmp_path / 'manifest.json'), badgeWidth=sheet['w'], badgeHeight=sheet['h'], seed=0)
+        return dict(badgebot.linebreakExceptions)
+
+    firstRun = drawIncremental()
+    assert firstRun
+    badgebot.linebreakExceptions.clear()
+    # every badge is reused this time, so nothing is drawn
+    assert drawIncremental() == firstRun
+
+
+def testNameOverridesInvalidateBadgeFiles(badgebot, tmp_path, monkeypatch):
+    slot = (badgebot.Attendee('Ada', 'Lovelace', 'Analytical', 'General'), 0, 0, 0, 0)
+    overridesPath = tmp_path / 'nameOverrides.json'
+    monkeypatch.setattr(badgebot, 'nameOverridesPath', str(overridesPath))
+    monkeypatch.setattr(badgebot, 'fileFingerprints', {})
+    overridesPath.write_text('{}')
+    before = badgebot.getBadgeFingerprint(slot, 100, 100)
+    overridesPath.write_text('{"Lovelace": {"lastName": "Love-lace"}}')
+    badgebot.fileFingerprints.clear()
+    assert badgebot.getBadgeFingerprint(slot, 100, 100) != before
+
+
+def testPalettesAreSpreadEvenly(badgebot):
+    # one copy each, with nothing next to them but the attendee before
+    palettes = [paletteId for attendee, paletteId, patternId in badgebot.assignDesigns(makeAttendees(badgebot, 30), seed=5)]
+    paletteCounts = [palettes.count(paletteId) for paletteId in range(len(badgebot.paletteTable))]
+    assert max(paletteCounts) - min(paletteCounts) <= 1
+
+
+def testDesignsRespectCopiesAndNeighbors(badgebot):
+    sheet = getSheet(badgebot)
+    for pageSlots in badgebot.paginateSheets(makeAttendees(badgebot, 60), sheet, seed=3):
+        for slotIndex, slot in enumerate(pageSlots):
+            for neighborIndex in sheet['neighbors'][slotIndex]:
+                neighbor = pageSlots[neighborIndex]
+                assert slot[1] != neighbor[1]
+                assert slot[2] != neighbor[2]
+
+
+def testSameNameAttendeesGetTheirOwnKeys(badgebot):
+    seenKeys = {}
+    attendee = badgebot.Attendee('Alex', 'Smith', 'Acme', 'General')
+    keys = [badgebot.getAttendeeKey(attendee, seenKeys) for i in range(2)]
+    keys.append(badgebot.getAttendeeKey(badgebot.Attendee('Alex', 'Smith', 'Other Co', 'General'), seenKeys))
+    assert len(set(keys)) == 3
+
+
+## FONTS
+
+def testMeasuringMissingCharactersIsLeftToDrawBot(badgebot, tmp_path):
+    fontPath = makeFont(str(tmp_path / 'latin.ttf'), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    assert badgebot.measureText('AB', fontPath, 10) == pytest.approx(12)
+    assert badgebot.measureText('李小龙', fontPath, 10) is None
+    assert badgebot.measureText('AB李', fontPath, 10) is None
+
+
+def useLatinNameFont(badgebot, tmp_path, monkeypatch):
+    fontPath = makeFont(str(tmp_path / 'latin.ttf'), 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-')
+    monkeypatch.setattr(badgebot, 'nameFont', fontPath)
+    monkeypatch.setattr(badgebot, 'nameFontFallback', fontPath)
+    for layer in badgebot.nameFonts:
+        monkeypatch.setitem(badgebot.nameFonts, layer, fontPath)
+    monkeypatch.setattr(badgebot, 'nameLayoutCache', {})
+
+
+def assertBatchMatchesOneAtATime(badgebot, names, w, h):
+    layouts = badgebot.layoutNames(names, w, h)
+    assert all(layout['fontSize'] > 0 for layout in layouts)
+    # lay each one out again from scratch, rather than getting the batch's layout back from the cache
+    badgebot.nameLayoutCache.clear()
+    for (firstName, lastName), layout in zip(names, layouts):
+        assert badgebot.layoutName(firstName, lastName, w, h) == layout
+
+
+def testNamesWithoutGlyphsStillGetLaidOut(badgebot, tmp_path, monkeypatch):
+    useLatinNameFont(badgebot, tmp_path, monkeypatch)
+    # two lines, so there is no space to measure in the latin font
+    names = [('李小龍李小龍', '張'), ('Anabelle', '李李李'), ('Anabelle', 'Lee')]
+    assertBatchMatchesOneAtATime(badgebot, names, 4 * badgebot.pt, 3 * badgebot.pt)
+
+
+def testBatchedLayoutsMatchOneAtATime(badgebot, tmp_path, monkeypatch):
+    useLatinNameFont(badgebot, tmp_path, monkeypatch)
+    names = [('Al', 'Ng'), ('Christopher', 'Tinizaray'), ('Jean-Luc', 'Smith-Jones'), ('Mary Kate', 'Van Der Berg'), ('Anabelle', 'Lee')]
+    assertBatchMatchesOneAtATime(badgebot, names, 4 * badgebot.pt, 3 * badgebot.pt)
+    assertBatchMatchesOneAtATime(badgebot, names, 4 * badgebot.pt, 3 * badgebot.pt - 20)
+
+
+def testKerningFromSeparateLookupsAddsUp(badgebot, tmp_path):
+    featureText = """
+        lookup first { pos A V -50; } first;
+        lookup second { pos A V -30; } second;
+        lookup split { pos A W -40; subtable; pos A W -10; pos A Y -20; } split;
+        feature kern { lookup first; lookup second; lookup split; } kern;
+        """
+    fontPath = makeFont(str(tmp_path / 'kerned.ttf'), 'AVWY', featureText)
+    ttFont = badgebot.TTFont(fontPath)
+    kerning = badgebot.getKerning(ttFont, ttFont.getBestCmap())
+    assert kerning[(ord('A'), ord('V'))] == -80
+    # the first subtable of a lookup to have the pair is the one that counts
+    assert kerning[(ord('A'), ord('W'))] == -40
+    assert kerning[(ord('A'), ord('Y'))] == -20
+
+
+## ATTENDEES
+
+def testTicketTypeFallsBackToTheNinthColumn(badgebot):
+    headers = ['First Name', 'Last Name', 'Company']
+    headerIndex = badgebot.buildHeaderIndex(headers, badgebot.columnMappings['eventbrite'], neededFields=['ticketType'])
+    row = ['Sam', 'Lee', 'Acme', '', '', '', '', '', 'Livestream']
+    attendee = badgebot.parseRowData(row, headerIndex)
+    assert list(badgebot.filterAttendees([attendee], excludeTicketTypes=['Livestream'])) == []
+
+
+def testFilteringOnAMissingColumnFails(badgebot):
+    mapping = {'firstName': 'First', 'lastName': 'Last', 'company': 'Company', 'ticketType': 'Ticket'}
+    assert badgebot.buildHeaderIndex(['First', 'Last'], mapping)[3] is None
+    with pytest.raises(ValueError):
+        badgebot.buildHeaderIndex(['First', 'Last'], mapping, neededFields=['ticketType'])
+
+
+## ANIMATION
+
+def testFailedAnimationsCleanUpTheirLayers(badgebot, tmp_path, monkeypatch):
+    monkeypatch.setattr(badgebot.tempfile, 'tempdir', str(tmp_path))
+    drawBadge = badgebot.drawBadge
+
+    def drawBadgeUntilTheFrames(*args, **kwargs):
+        if 'pattern' in kwargs.get('layers', []):
+            raise RuntimeError('frame failed')
+        return drawBadge(*args, **kwargs)
+    monkeypatch.setattr(badgebot, 'drawBadge', drawBadgeUntilTheFrames)
+
+    with pytest.raises(RuntimeError):
+        badgebot.drawBadgeAnimation(1920, 1080, 'Ada', 'Lovelace', 'Analytical', str(tmp_path / 'ada.gif'), colorPalette=badgebot.paletteTable[0], totalFrames=2)
+    assert os.listdir(str(tmp_path)) == []
+
+
+## BADGE SERVICE
+
+@pytest.fixture
+def badgeServer(badgebot):
+    server = badgebot.HTTPServer(('127.0.0.1', 0), badgebot.BadgeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%s' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def postBadge(url, body, contentType='application/json'):
+    request = urllib.request.Request(url + '/badge', data=body, headers={'Content-Type': contentType})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+@pytest.mark.parametrize('body', [b'{not json', b'["a list"]', b'{"firstName": 3}', b'\xff\xfe'])
+def testServiceRejectsBadInput(badgeServer, body):
+    assert postBadge(badgeServer, body) == 400
+
+
+def testServiceRejectsLargeBodies(badgebot, badgeServer):
+    body = json.dumps({'firstName': 'x' * badgebot.BadgeRequestHandler.maxBodySize}).encode('utf-8')
+    assert postBadge(badgeServer, body) == 413
+
+
+def testServiceReportsDrawingErrors(badgebot, badgeServer, monkeypatch):
+    def failToDraw(*args, **kwargs):
+        raise RuntimeError('no fonts')
+    monkeypatch.setattr(badgebot, 'renderServiceBadge', failToDraw)
+    assert postBadge(badgeServer, b'{"firstName": "Sam"}') == 500
+
+
+## JOBS
+
+def writeManifest(tmp_path, jobs):
+    manifestPath = tmp_path / 'jobs.json'
+    manifestPath.write_text(json.dumps({'jobs': jobs}), encoding='utf-8')
+    return str(manifestPath)
+
+
+def testFailedJobsAreReportedAndTheRestRun(badgebot, tmp_path, capsys):
+    manifestPath = writeManifest(tmp_path, [
+        {'name': 'missing-csv', 'csv': 'nowhere.csv', 'format': 'single'},
+        {'name': 'bad-format', 'csv': 'nowhere.csv', 'format': 'poster'},
+        ])
+    badgebot.runJobs(manifestPath, str(tmp_path / 'output'))
+    report = capsys.readouterr().out
+    assert 'running job bad-format' in report
+    assert '2 failed' in report
+
+
+def testBadJobsAreReportedAsFailed(badgebot, tmp_path, capsys):
+    manifestPath = writeManifest(tmp_path, [
+        {'name': '../outside', 'csv': 'nowhere.csv', 'format': 'single'},
+        {'name': '..', 'csv': 'nowhere.csv', 'format': 'single'},
+        {'csv': 'nowhere.csv', 'format': 'single'},
+        {'name': 'no-format', 'csv': 'nowhere.csv'},
+        ])
+    badgebot.runJobs(manifestPath, str(tmp_path / 'output'))
+    report = capsys.readouterr().out
+    assert '4 failed' in report
+    assert 'plain folder name' in report
+    assert 'missing format' in report
+    assert not (tmp_path / 'outside').exists()
+
+
+def testJobNamesMustBeUnique(badgebot, tmp_path):
+    manifestPath = writeManifest(tmp_path, [
+        {'name': 'sheets', 'csv': 'a.csv', 'format': 'sheets'},
+        {'name': 'sheets', 'csv': 'b.csv', 'format': 'sheets'},
+        ])
+    with pytest.raises(ValueError):
+        badgebot.runJobs(manifestPath, str(tmp_path / 'output'))